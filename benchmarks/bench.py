@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+"""Benchmarks for the zebo measurements data model.
+
+Generates a synthetic CSV file, times the main model operations on it,
+and prints the results as JSON so that runs can be compared:
+
+    python benchmarks/bench.py --rows 1000000 --output before.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from zebo.csvio import CSVFormat
+from zebo.model import Measurements
+from generate import generate
+
+def peak_rss():
+    """Get the peak resident set size of this process, in bytes"""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, but macOS reports bytes
+    if sys.platform == 'darwin':
+        return usage
+    return usage * 1024
+
+class Benchmark(object):
+
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.results = []
+
+    def timed(self, name, func, calls=1):
+        start = time.time()
+        for i in range(calls):
+            func()
+        elapsed = time.time() - start
+
+        self.results.append({'name': name,
+                             'calls': calls,
+                             'seconds': elapsed,
+                             'seconds_per_call': elapsed / calls,
+                             'peak_rss': peak_rss()})
+        sys.stderr.write("{:<24} {:>10.6f}s  ({} calls)\n"
+                         .format(name, elapsed, calls))
+
+    def open_model(self, filename):
+        csv_format = None
+        if self.args.no_fast_csv:
+            csv_format = CSVFormat(fast=False)
+        return Measurements(filename, mapped=self.args.mapped,
+                            workers=self.args.workers, cache=self.args.cache,
+                            csv_format=csv_format)
+
+    def random_path(self, model, depth):
+        path = []
+        for level in range(depth):
+            path.append(self.rng.choice(model.metadata_values(path)))
+        return path
+
+    def run(self, filename):
+        args = self.args
+
+        model = self.open_model(filename)
+        self.timed('load', model.metadata_keys)
+        load = self.results[-1]
+        load['rows_per_sec'] = len(model.table) / load['seconds']
+
+        # Loading again exercises the binary cache, if it's enabled
+        reopened = self.open_model(filename)
+        self.timed('reopen', reopened.metadata_keys)
+        del reopened
+
+        depth = len(model.metadata_keys())
+        keys = model.measurement_keys()
+        mutable_keys = [key for key in keys
+                        if model.is_measurement_mutable(key)]
+
+        prefixes = [self.random_path(model, self.rng.randint(0, depth - 1))
+                    for i in range(args.samples)]
+        paths = [self.random_path(model, depth) for i in range(args.samples)]
+
+        def metadata_values():
+            for prefix in prefixes:
+                model.metadata_values(prefix)
+        self.timed('metadata_values', metadata_values)
+
+        top_prefixes = [[value] for value
+                        in model.metadata_values([])[:args.samples]]
+
+        def paths_with_prefix():
+            for prefix in top_prefixes:
+                for path in model.paths_with_prefix(prefix):
+                    pass
+        self.timed('paths_with_prefix', paths_with_prefix)
+
+        def get_measurement():
+            for path in paths:
+                for key in keys:
+                    model.get_measurement(path, key)
+        self.timed('get_measurement', get_measurement)
+
+        def measurement_summary():
+            for prefix in prefixes:
+                model.measurement_summary(prefix)
+        self.timed('measurement_summary', measurement_summary)
+
+        def walk(step):
+            path = paths[0]
+            for i in range(args.samples):
+                path = step(path)
+                if path is None:
+                    break
+        self.timed('path_next', lambda: walk(model.path_next))
+        self.timed('path_previous', lambda: walk(model.path_previous))
+
+        if mutable_keys:
+            def bulk_set():
+                for prefix in top_prefixes:
+                    model.set_measurement(prefix, mutable_keys[0], 'bench',
+                                          partial=True)
+            self.timed('bulk_set_measurement', bulk_set)
+
+            def single_set():
+                for path in paths:
+                    model.set_measurement(path, mutable_keys[-1], 'x')
+            self.timed('set_measurement', single_set)
+
+            self.timed('commit', model.commit)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the zebo data model")
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--key-cols', type=int, default=3)
+    parser.add_argument('--cardinality', type=int, default=10)
+    parser.add_argument('--mutable', type=int, default=4)
+    parser.add_argument('--immutable', type=int, default=4)
+    parser.add_argument('--fill', type=float, default=0.5)
+    parser.add_argument('--samples', type=int, default=1000,
+                        help="number of paths sampled for each operation")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--mapped', action='store_true', default=None,
+                        help="use the memory-mapped backend")
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--cache', action='store_true', default=None,
+                        help="use the binary cache")
+    parser.add_argument('--no-fast-csv', action='store_true',
+                        help="parse every row with the csv module")
+    parser.add_argument('--csv', metavar='FILE',
+                        help="benchmark a copy of FILE instead of a "
+                        "generated file")
+    parser.add_argument('--output', metavar='FILE',
+                        help="write JSON results to FILE instead of "
+                        "standard output")
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp(prefix='zebo-bench-')
+    try:
+        filename = os.path.join(directory, 'bench.csv')
+        if args.csv:
+            shutil.copyfile(args.csv, filename)
+        else:
+            generate(filename, args.rows, args.key_cols, args.cardinality,
+                     args.mutable, args.immutable, args.fill, args.seed)
+
+        bench = Benchmark(args)
+        bench.run(filename)
+
+        report = {'params': vars(args),
+                  'file_size': os.path.getsize(filename),
+                  'python': platform.python_version(),
+                  'platform': platform.platform(),
+                  'results': bench.results}
+    finally:
+        shutil.rmtree(directory)
+
+    if args.output:
+        with open(args.output, 'w') as out_fp:
+            json.dump(report, out_fp, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    main()
+
+# Local variables:
+# indent-tabs-mode: nil
+# tab-width: 4
+# End:
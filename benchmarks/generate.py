@@ -0,0 +1,54 @@
+import random
+
+from zebo import csvio
+
+################################################################
+# Synthetic measurement CSV files
+################################################################
+
+def generate(filename, rows, key_cols=3, cardinality=10, mutable=4,
+             immutable=4, fill=0.5, seed=0):
+    """Write a synthetic measurement CSV file.
+
+    The file has `key_cols` metadata columns, followed by `immutable`
+    read-only and `mutable` editable measurement columns.  Each metadata
+    column below the first has `cardinality` distinct values per parent;
+    the first absorbs the remaining rows, so every path is unique and
+    the rows are in path order.  A fraction `fill` of the editable
+    cells are given values."""
+    rng = random.Random(seed)
+
+    header = (['Key{}='.format(i) for i in range(key_cols)]
+              + ['Reading{}'.format(i) for i in range(immutable)]
+              + ['Value{}?'.format(i) for i in range(mutable)])
+
+    with open(filename, 'wb') as out_fp:
+        csv_writer, out = csvio.DEFAULT_FORMAT.writer(out_fp)
+        csv_writer.writerow(header)
+
+        for row_idx in range(rows):
+            row = []
+
+            remainder = row_idx
+            for level in range(key_cols - 1, -1, -1):
+                if level == 0:
+                    row.insert(0, str(remainder))
+                else:
+                    row.insert(0, str(remainder % cardinality))
+                    remainder //= cardinality
+
+            for i in range(immutable):
+                row.append('{:.4f}'.format(rng.random()))
+
+            for i in range(mutable):
+                if rng.random() < fill:
+                    row.append(str(rng.randint(0, 100)))
+                else:
+                    row.append('')
+
+            csv_writer.writerow(row)
+
+# Local variables:
+# indent-tabs-mode: nil
+# tab-width: 4
+# End:
@@ -1,13 +1,32 @@
 #!/usr/bin/env python3
 
+import logging
+import os
 import sys
 from PyQt4 import Qt, QtCore, QtGui
-from zebo.measurements import MeasurementsData
+from zebo import instrument
+from zebo.measurements import (DatasetData, MeasurementsData,
+                               MeasurementsTableModel)
+from zebo.model import MergeConflict
+from zebo.schema import NUMBER
+
+# Number of conflicting cells listed when asking whether to overwrite
+# them
+CONFLICTS_SHOWN = 10
 
 ################################################################
 # User interface
 ################################################################
 
+def _editor_row(model, path, row_idx):
+    # The row that an editor shows when a full path is selected.  The
+    # cursor's row is used if it's still on the path, as several rows
+    # can share one.
+    if (row_idx is not None and row_idx < model.row_count()
+        and model.path_at_row(row_idx) == path):
+        return row_idx
+    return model.row_with_path(path)
+
 class NavigatorComboBox(QtGui.QComboBox):
 
     currentPathChanged = QtCore.pyqtSignal()
@@ -19,6 +38,15 @@ class NavigatorComboBox(QtGui.QComboBox):
         self.previous = previous
         self.last_value = ''
 
+        # The parent path that the current items were listed for, the
+        # listed values, and a map from value to item index
+        self.items_path = None
+        self.values = None
+        self.positions = {}
+
+        # Set while the previous box is being moved by setCurrentPath()
+        self.setting_path = False
+
         # Make sure that if the previous box changes, this get updated
         if previous is not None:
             previous.currentIndexChanged.connect(self._prev_index_changed)
@@ -27,10 +55,6 @@ class NavigatorComboBox(QtGui.QComboBox):
         # path change signal
         self.currentIndexChanged.connect(self._emit_path_changed)
 
-        # Make sure that if the data changes, this widget gets updated
-        if previous is None:
-            self.model.dataChanged.connect(self.update)
-
         self.update()
 
     def _emit_path_changed(self):
@@ -75,15 +99,22 @@ class NavigatorComboBox(QtGui.QComboBox):
         # Recurse up to the root first, and let that update, then
         # cascade back down
         if self.previous is not None:
-            self.previous.currentIndexChanged.disconnect(self._prev_index_changed)
-            self.previous.setCurrentPath(full_path[:-1])
-            self.previous.currentIndexChanged.connect(self._prev_index_changed)
+            self.setting_path = True
+            try:
+                self.previous.setCurrentPath(full_path[:-1])
+            finally:
+                self.setting_path = False
 
         # Force update of this element
         self.update(full_path[-1])
 
     def _prev_index_changed(self):
-        self.update()
+        if not self.setting_path:
+            self.update()
+
+    def invalidate(self):
+        """Make the next update list the values from the model again"""
+        self.items_path = None
 
     def update(self, move_to=None):
         if move_to is not None:
@@ -95,37 +126,37 @@ class NavigatorComboBox(QtGui.QComboBox):
             current_value = self.last_value
         self.last_value = current_value
 
+        # The items only need to be replaced if the parent path has
+        # changed, and then only if it has different values
         path = self._parent_path()
+        if path != self.items_path:
+            self.items_path = path
 
-        # Set the new list of values
-        self.blockSignals(True)
+            values = self.model.metadata_values(path)
+            if values != self.values:
+                self._set_values(values)
 
-        values = self.model.metadata_values(path)
+        # Try to get back to the original value
+        index = self.positions.get(current_value, 0)
 
-        def try_int(value):
-            try:
-                return int(value)
-            except:
-                return 0
+        # Make sure that we always get a currentIndexChanged signal
+        # emission
+        if index == self.currentIndex():
+            self.currentIndexChanged.emit(index)
+        else:
+            self.setCurrentIndex(index)
 
-        values.sort(key=try_int)
-        values = ['(All)'] + values
+    def _set_values(self, values):
+        self.values = values
+        self.positions = dict((value, idx + 1)
+                              for idx, value in enumerate(values))
 
+        self.blockSignals(True)
         self.clear()
-        self.addItems(values)
-
-        # This makes sure that we always get a currentIndexChanged
-        # signal emission
+        self.addItems(['(All)'] + values)
         self.setCurrentIndex(-1)
-
         self.blockSignals(False)
 
-        # Try to get back to the original value
-        try:
-            self.setCurrentIndex(values.index(current_value))
-        except:
-            self.setCurrentIndex(0)
-
 class NavigatorWidget(QtGui.QWidget):
 
     currentPathChanged = QtCore.pyqtSignal(list)
@@ -165,6 +196,10 @@ class NavigatorWidget(QtGui.QWidget):
         # order to get updates every time the selected path changes
         combobox.currentIndexChanged.connect(self._emit_path_changed)
 
+        # Make sure that if the set of paths changes, the comboboxes get
+        # updated.  Measurement edits can't change the paths.
+        self.model.structureChanged.connect(self._structure_changed)
+
     def currentPath(self):
         return self.comboboxes[-1].currentPath()
 
@@ -174,16 +209,23 @@ class NavigatorWidget(QtGui.QWidget):
     def _emit_path_changed(self):
         self.currentPathChanged.emit(self.currentPath())
 
+    def _structure_changed(self):
+        for combobox in self.comboboxes:
+            combobox.invalidate()
+        # The change cascades down from the first combobox
+        self.comboboxes[0].update()
+
 class EditorDisplay(QtGui.QLabel):
 
     MULTI_VALUE_TEXT="(Multiple values)"
 
-    def __init__(self, model, name, **kwargs):
+    def __init__(self, model, name, path=[], row_idx=None, **kwargs):
         super(EditorDisplay, self).__init__(**kwargs)
 
         self.model = model
         self.name = name
-        self.path = []
+        self.path = list(path)
+        self.row_idx = row_idx
 
         self.update()
 
@@ -196,14 +238,7 @@ class EditorDisplay(QtGui.QLabel):
 
         if not self.model.validate_path(self.path, partial=False):
             # Multiple rows selected
-            seen = set()
-            for path in self.model.paths_with_prefix(self.path):
-                value = self.model.get_measurement(path, self.name)
-                if value in seen:
-                    continue
-                seen.add(value)
-
-            values = sorted(seen)
+            values = self.model.measurement_values(self.path, self.name)
 
             if len(values) > 1:
                 self.setText(self.MULTI_VALUE_TEXT)
@@ -212,25 +247,35 @@ class EditorDisplay(QtGui.QLabel):
 
         else:
             # Single row selected
-            self.setText(self.model.get_measurement(self.path, self.name))
+            row_idx = _editor_row(self.model, self.path, self.row_idx)
+            self.setText(self.model.get_row_measurement(row_idx, self.name))
 
-    def setCurrentPath(self, path):
-        if path == self.path:
+    def refresh(self):
+        self.update()
+
+    def setCurrentPath(self, path, row_idx=None):
+        if path == self.path and row_idx == self.row_idx:
             return
         self.path = path
+        self.row_idx = row_idx
         self.update()
 
 class EditorComboBox(QtGui.QComboBox):
 
     NO_VALUE_TEXT="(No value)"
     MULTI_VALUE_TEXT="(Multiple values)"
+    INVALID_STYLE="QComboBox { color: red }"
 
-    def __init__(self, model, name, **kwargs):
+    def __init__(self, model, name, path=[], row_idx=None, **kwargs):
         super(EditorComboBox, self).__init__(**kwargs)
 
         self.model = model
         self.name = name
-        self.path = []
+        self.path = list(path)
+        self.row_idx = row_idx
+
+        # Set while this editor is writing its value to the model
+        self.editing = False
 
         self.setEditable(True)
         self.lineEdit().setPlaceholderText(self.NO_VALUE_TEXT)
@@ -244,6 +289,8 @@ class EditorComboBox(QtGui.QComboBox):
             pass
 
         self.clear()
+        self.setToolTip('')
+        self.setStyleSheet('')
 
         if not self.model.validate_path(self.path, partial=True):
             # Invalid path
@@ -252,14 +299,7 @@ class EditorComboBox(QtGui.QComboBox):
 
         if not self.model.validate_path(self.path, partial=False):
             # Multiple rows selected
-            seen = set()
-            for path in self.model.paths_with_prefix(self.path):
-                value = self.model.get_measurement(path, self.name)
-                if value in seen:
-                    continue
-                seen.add(value)
-
-            values = sorted(seen)
+            values = self.model.measurement_values(self.path, self.name)
             self.addItems(values)
 
             if len(values) > 1:
@@ -275,78 +315,328 @@ class EditorComboBox(QtGui.QComboBox):
             self.editTextChanged.connect(self._update_model)
 
         else:
-            # Single row selected
+            # Single row selected, offering the choices of an enum
+            ctype = self.model.measurement_type(self.name)
+            if ctype is not None and ctype.choices:
+                self.addItems(ctype.choices)
+
             self.lineEdit().setPlaceholderText(self.NO_VALUE_TEXT)
             self.setEnabled(True)
-            self.setEditText(self.model.get_measurement(self.path, self.name))
+            row_idx = _editor_row(self.model, self.path, self.row_idx)
+            self.setEditText(self.model.get_row_measurement(row_idx,
+                                                            self.name))
 
             # Make sure that the model gets updated when the user edits
             # the value.
             self.editTextChanged.connect(self._update_model)
 
-    def setCurrentPath(self, path):
-        if path == self.path:
+    def refresh(self):
+        # Don't reset the text while the user is typing into it
+        if not self.editing:
+            self.update()
+
+    def setCurrentPath(self, path, row_idx=None):
+        if path == self.path and row_idx == self.row_idx:
             return
         self.path = path
+        self.row_idx = row_idx
         self.update()
 
     def _update_model(self):
         new_value = self.currentText()
 
-        if not self.model.validate_path(self.path, partial=False):
-            # Multiple rows selected
-            self.model.set_measurement(self.path, self.name, new_value, partial=True)
+        self.editing = True
+        try:
+            if not self.model.validate_path(self.path, partial=False):
+                # Multiple rows selected
+                self.model.set_measurement(self.path, self.name, new_value,
+                                           partial=True)
+            else:
+                # Single row selected
+                row_idx = _editor_row(self.model, self.path, self.row_idx)
+                self.model.set_row_measurement(row_idx, self.name,
+                                               new_value)
+        except ValueError as e:
+            # The value may only be partly typed, so leave it in the
+            # editor but not in the model
+            self.setToolTip(str(e))
+            self.setStyleSheet(self.INVALID_STYLE)
         else:
-            # Single row selected
-            self.model.set_measurement(self.path, self.name, new_value)
+            self.setToolTip('')
+            self.setStyleSheet('')
+        finally:
+            self.editing = False
 
 class EditorWidget(QtGui.QWidget):
+    """A label and editor for each measurement, with the read-only ones
+    on the left and the editable ones on the right.
+
+    This is meant to be put in a QScrollArea.  Only the editors in view
+    are created and kept up to date; the others catch up when they're
+    scrolled into view."""
+
+    SPACING = 6
+
+    # Number of rows beyond each edge of the view that are kept up to
+    # date, so that scrolling a little doesn't show stale values
+    OVERSCAN = 4
 
     def __init__(self, model, **kwargs):
         super(EditorWidget, self).__init__(**kwargs)
 
         self.model = model
+        self.path = []
+        self.row_idx = None
+
+        # The measurement keys that match the filter, read-only and
+        # editable
+        self.columns = ([], [])
+
+        # Map of measurement key to the label and editor created for it
+        self.editors = {}
+
+        # Keys of the editors in view, and of the others that need
+        # refreshing when they're next shown
+        self.shown = set()
+        self.stale = set()
+
+        # The editors are combo boxes, which are the height of a line
+        # of text and the style's frame around it
+        option = QtGui.QStyleOptionComboBox()
+        option.initFrom(self)
+        text_size = QtCore.QSize(0, self.fontMetrics().height())
+        self.row_height = self.style().sizeFromContents(
+            QtGui.QStyle.CT_ComboBox, option, text_size,
+            self).height() + self.SPACING
+
+        self.setFilter('')
+
+        self.model.cellsChanged.connect(self._cells_changed)
+        self.model.structureChanged.connect(self._structure_changed)
+
+    def setFilter(self, text):
+        """Only show the measurements with `text` in their names"""
+        text = text.lower()
+        immutable_keys = []
+        mutable_keys = []
+        for key in self.model.measurement_keys():
+            if text not in key.replace("_", " ").lower():
+                continue
+            if self.model.is_measurement_mutable(key):
+                mutable_keys.append(key)
+            else:
+                immutable_keys.append(key)
+        self.columns = (immutable_keys, mutable_keys)
+
+        self.setMinimumHeight(self.row_height * max(len(immutable_keys),
+                                                    len(mutable_keys)))
+        self.updateVisible()
+
+    def _editor(self, key, mutable):
+        # Get the label and editor for a key, creating them if necessary
+        widgets = self.editors.get(key)
+        if widgets is None:
+            label = QtGui.QLabel(key.replace("_"," "), self)
+            if mutable:
+                editor = EditorComboBox(self.model, key, self.path,
+                                        self.row_idx, parent=self)
+            else:
+                editor = EditorDisplay(self.model, key, self.path,
+                                       self.row_idx, parent=self)
+            widgets = self.editors[key] = (label, editor)
+        return widgets
+
+    def updateVisible(self):
+        """Lay out the editors in view, and bring them up to date"""
+        # In a scroll area, the viewport is the parent, and this widget
+        # is moved up by the scrolled distance
+        parent = self.parentWidget()
+        top = max(0, -self.y())
+        if parent is not None:
+            bottom = top + parent.height()
+        else:
+            bottom = top + self.height()
+        first = max(0, top // self.row_height - self.OVERSCAN)
+        last = bottom // self.row_height + 1 + self.OVERSCAN
+
+        half = self.width() // 2
+        label_width = half * 2 // 5
+        height = self.row_height - self.SPACING
+
+        shown = set()
+        for side, keys in enumerate(self.columns):
+            for idx in range(first, min(last, len(keys))):
+                key = keys[idx]
+                label, editor = self._editor(key, side == 1)
+
+                x = side * half
+                y = idx * self.row_height
+                label.setGeometry(x + self.SPACING, y,
+                                  label_width - self.SPACING, height)
+                editor.setGeometry(x + label_width, y,
+                                   half - label_width - self.SPACING, height)
+                label.show()
+                editor.show()
+
+                if (editor.path != self.path
+                    or editor.row_idx != self.row_idx):
+                    editor.setCurrentPath(self.path, self.row_idx)
+                elif key in self.stale:
+                    editor.refresh()
+                self.stale.discard(key)
+                shown.add(key)
+
+        for key in self.shown - shown:
+            label, editor = self.editors[key]
+            label.hide()
+            editor.hide()
+        self.shown = shown
+
+    def moveEvent(self, event):
+        super(EditorWidget, self).moveEvent(event)
+        self.updateVisible()
+
+    def resizeEvent(self, event):
+        super(EditorWidget, self).resizeEvent(event)
+        self.updateVisible()
+
+    def setCurrentPath(self, path, row_idx=None):
+        """Show the measurements under `path`, or in the row `row_idx` if
+        it's one of several with the same full path"""
+        self.path = path
+        self.row_idx = row_idx
+        for key in self.shown:
+            self.editors[key][1].setCurrentPath(path, row_idx)
+
+    def _cells_changed(self, rows, keys):
+        # Only refresh the editors for the changed columns, and only if
+        # the changed rows are under the current path
+        if not self.model.has_rows_with_prefix(rows, self.path):
+            return
 
-        self._init_ui()
+        for key in keys:
+            if key in self.shown:
+                self.editors[key][1].refresh()
+            elif key in self.editors:
+                self.stale.add(key)
+
+    def _structure_changed(self):
+        for key, (label, editor) in self.editors.items():
+            if key in self.shown:
+                editor.refresh()
+            else:
+                self.stale.add(key)
+
+class EditorPanel(QtGui.QWidget):
+    """Scrolling measurement editors, with a box to filter them by name"""
+
+    def __init__(self, model, **kwargs):
+        super(EditorPanel, self).__init__(**kwargs)
 
-    def _init_ui(self):
-        # Overall vertical layout
         vbox = QtGui.QVBoxLayout()
         self.setLayout(vbox)
 
-        # Layout the controls in a grid
-        grid = QtGui.QGridLayout()
-        vbox.addLayout(grid)
+        self.filter = QtGui.QLineEdit()
+        self.filter.setPlaceholderText("Filter measurements")
+        vbox.addWidget(self.filter)
+
+        scroller = QtGui.QScrollArea()
+        scroller.setHorizontalScrollBarPolicy(Qt.Qt.ScrollBarAlwaysOff)
+        scroller.setVerticalScrollBarPolicy(Qt.Qt.ScrollBarAsNeeded)
+        vbox.addWidget(scroller, stretch=1)
+
+        self.editor = EditorWidget(model=model)
+        scroller.setWidget(self.editor)
+        scroller.setWidgetResizable(True)
 
-        # Create a label and editor combobox for each measurement item
-        self.editors = []
+        self.filter.textChanged.connect(self._filter_changed)
 
-        all_keys = [(x, self.model.is_measurement_mutable(x))
-                     for x in self.model.measurement_keys()]
+    def _filter_changed(self, text):
+        self.editor.setFilter(str(text))
 
-        immutable_keys = [x[0] for x in all_keys if not x[1]]
-        for idx, name in enumerate(immutable_keys):
-            grid.addWidget(QtGui.QLabel(name.replace("_"," ")), idx, 0)
-            editor = EditorDisplay(self.model, name)
-            grid.addWidget(editor, idx, 1)
-            self.editors.append(editor)
+    def setCurrentPath(self, path, row_idx=None):
+        self.editor.setCurrentPath(path, row_idx)
 
-        grid.setColumnStretch(1, 1)
+    def resizeEvent(self, event):
+        # The view may have grown without the editors being resized
+        super(EditorPanel, self).resizeEvent(event)
+        self.editor.updateVisible()
 
-        mutable_keys = [x[0] for x in all_keys if x[1]]
-        for idx, name in enumerate(mutable_keys):
-            grid.addWidget(QtGui.QLabel(name.replace("_"," ")), idx, 2)
-            editor = EditorComboBox(self.model, name)
-            grid.addWidget(editor, idx, 3)
-            self.editors.append(editor)
+class StatisticsWidget(QtGui.QTableWidget):
+    """Table of statistics of the numeric measurements under the
+    current path.  They're only computed while the table is shown."""
 
-        grid.setColumnStretch(3, 1)
+    HEADERS = ["Measurement", "Count", "Missing", "Min", "Max", "Mean",
+               "Std dev", "Histogram"]
+    BARS = u'\u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588'
 
-        vbox.addStretch(1)
+    def __init__(self, model, **kwargs):
+        super(StatisticsWidget, self).__init__(**kwargs)
+
+        self.model = model
+        self.path = []
+
+        # Set when the statistics have changed while hidden
+        self.stale = True
+
+        self.setColumnCount(len(self.HEADERS))
+        self.setHorizontalHeaderLabels(self.HEADERS)
+        self.setEditTriggers(QtGui.QAbstractItemView.NoEditTriggers)
+        self.verticalHeader().hide()
+
+        self.model.cellsChanged.connect(self._invalidate)
+        self.model.structureChanged.connect(self._invalidate)
 
     def setCurrentPath(self, path):
-        for e in self.editors:
-            e.setCurrentPath(path)
+        if path == self.path:
+            return
+        self.path = path
+        self._invalidate()
+
+    def _invalidate(self, *args):
+        self.stale = True
+        if self.isVisible():
+            self.update()
+
+    def showEvent(self, event):
+        super(StatisticsWidget, self).showEvent(event)
+        if self.stale:
+            self.update()
+
+    def update(self):
+        self.stale = False
+
+        rows = []
+        if self.model.validate_path(self.path, partial=True):
+            for key in self.model.measurement_keys():
+                stats = self.model.measurement_stats(self.path, key)
+                if stats.count:
+                    rows.append((key, stats))
+
+        self.setRowCount(len(rows))
+        for row, (key, stats) in enumerate(rows):
+            ctype = self.model.measurement_type(key) or NUMBER
+
+            # The mean of an enum isn't meaningful
+            if ctype.choices:
+                mean = stddev = ''
+            else:
+                mean = ctype.format(stats.mean)
+                stddev = NUMBER.format(stats.stddev)
+
+            texts = [key, str(stats.count), str(stats.missing),
+                     ctype.format(stats.min), ctype.format(stats.max),
+                     mean, stddev, self._bars(stats.histogram)]
+            for column, text in enumerate(texts):
+                self.setItem(row, column, QtGui.QTableWidgetItem(text))
+
+        self.resizeColumnsToContents()
+
+    def _bars(self, histogram):
+        # Empty bins are left blank, so they stand out from small ones
+        top = max(histogram)
+        return u''.join(self.BARS[(len(self.BARS) - 1) * count // top]
+                        if count else u' ' for count in histogram)
 
 class TopLevelWidget(QtGui.QWidget):
     def __init__(self, model, **kwargs):
@@ -354,9 +644,15 @@ class TopLevelWidget(QtGui.QWidget):
 
         self.model = model
 
+        # The table row being displayed, if the navigator has a full
+        # path selected
+        self.cursor = None
+
         self._init_ui()
 
-        self.model.dataChanged.connect(self.update)
+        self.model.dirtyChanged.connect(self._update_modified)
+        self.model.structureChanged.connect(self._update_structure)
+        self.model.dataChanged.connect(self._update_history)
 
         self.update()
 
@@ -368,18 +664,26 @@ class TopLevelWidget(QtGui.QWidget):
         hbox = QtGui.QHBoxLayout()
         vbox.addLayout(hbox, stretch=1)
 
-        scroller = QtGui.QScrollArea()
-        scroller.setHorizontalScrollBarPolicy(Qt.Qt.ScrollBarAlwaysOff)
-        scroller.setVerticalScrollBarPolicy(Qt.Qt.ScrollBarAsNeeded)
-
         self.navigator = NavigatorWidget(model=self.model)
-        self.editor = EditorWidget(model=self.model)
+        self.editor = EditorPanel(model=self.model)
 
-        scroller.setWidget(self.editor)
-        scroller.setWidgetResizable(True)
+        # Grid of all the rows under the current path
+        self.table_model = MeasurementsTableModel(self.model)
+        self.table = QtGui.QTableView()
+        self.table.setModel(self.table_model)
+        self.table.verticalHeader().setResizeMode(QtGui.QHeaderView.Fixed)
+
+        tabs = QtGui.QTabWidget()
+        tabs.addTab(self.editor, "Editor")
+        tabs.addTab(self.table, "Table")
+
+        # Optional statistics of the rows under the current path
+        self.stats = StatisticsWidget(self.model)
+        self.stats.hide()
 
         hbox.addWidget(self.navigator, stretch=1)
-        hbox.addWidget(scroller, stretch=2)
+        hbox.addWidget(tabs, stretch=2)
+        hbox.addWidget(self.stats, stretch=2)
 
         # Control widgets
         hbox = QtGui.QHBoxLayout()
@@ -391,48 +695,197 @@ class TopLevelWidget(QtGui.QWidget):
         self.next_button = QtGui.QPushButton("Next")
         hbox.addWidget(self.next_button)
 
+        self.undo_button = QtGui.QPushButton("Undo")
+        self.undo_button.setShortcut(
+            QtGui.QKeySequence(QtGui.QKeySequence.Undo))
+        hbox.addWidget(self.undo_button)
+
+        self.redo_button = QtGui.QPushButton("Redo")
+        self.redo_button.setShortcut(
+            QtGui.QKeySequence(QtGui.QKeySequence.Redo))
+        hbox.addWidget(self.redo_button)
+
+        self.stats_button = QtGui.QPushButton("Statistics")
+        self.stats_button.setCheckable(True)
+        hbox.addWidget(self.stats_button)
+
         hbox.addStretch(1)
 
+        self.status = QtGui.QLabel()
+        hbox.addWidget(self.status)
+
         self.save_button = QtGui.QPushButton("Save changes")
         hbox.addWidget(self.save_button)
 
-        self.navigator.currentPathChanged.connect(self.editor.setCurrentPath)
         self.navigator.currentPathChanged.connect(self._update_nav)
+        self.navigator.currentPathChanged.connect(self.table_model.setPrefix)
+        self.navigator.currentPathChanged.connect(self.stats.setCurrentPath)
 
         self.prev_button.clicked.connect(self._previous)
         self.next_button.clicked.connect(self._next)
-        self.save_button.clicked.connect(self.model.commit)
+        self.save_button.clicked.connect(self._save)
+        self.undo_button.clicked.connect(self.model.undo)
+        self.redo_button.clicked.connect(self.model.redo)
+        self.stats_button.toggled.connect(self.stats.setVisible)
+
+        self.model.progress.connect(self._show_progress)
+        self.model.commitFinished.connect(self._commit_finished)
+
+    def _save(self):
+        # The file is written in the background, and editing can
+        # continue in the meantime
+        self.save_button.setEnabled(False)
+        self.model.commit_async()
+
+    def _show_progress(self, stage, done, total):
+        if done < total:
+            self.status.setText("{}...".format(stage))
+        else:
+            self.status.setText('')
+
+    def _commit_finished(self, error):
+        self.status.setText('')
+        self._update_modified(self.model.is_modified())
+
+        if isinstance(error, MergeConflict):
+            self._resolve_conflicts(error)
+        elif error is not None:
+            QtGui.QMessageBox.critical(
+                self, "Zebo", "Couldn't save '{}': {}".format(
+                    self.model.get_filename(), error))
+
+    def _resolve_conflicts(self, error):
+        lines = [str(error) + ':', '']
+        for path, key, ours, theirs in error.conflicts[:CONFLICTS_SHOWN]:
+            if theirs is None:
+                theirs = "(row removed)"
+            lines.append("{} / {}: yours '{}', theirs '{}'".format(
+                ' / '.join(path), key, ours, theirs))
+        if len(error.conflicts) > CONFLICTS_SHOWN:
+            lines.append("...")
+        lines.extend(['', "Save your edits over theirs?"])
+
+        answer = QtGui.QMessageBox.question(
+            self, "Zebo", '\n'.join(lines),
+            QtGui.QMessageBox.Yes | QtGui.QMessageBox.No,
+            QtGui.QMessageBox.No)
+        if answer == QtGui.QMessageBox.Yes:
+            self.save_button.setEnabled(False)
+            self.model.commit_async(overwrite=True)
+
+    def closeEvent(self, event):
+        # Unsaved edits are still in the journal until they're either
+        # saved or discarded
+        if self.model.is_busy():
+            QtGui.QMessageBox.information(
+                self, "Zebo", "Please wait until '{}' has been saved.".format(
+                    self.model.get_filename()))
+            event.ignore()
+            return
+
+        if self.model.is_modified():
+            answer = QtGui.QMessageBox.question(
+                self, "Zebo", "Save the changes to '{}'?".format(
+                    self.model.get_filename()),
+                QtGui.QMessageBox.Save | QtGui.QMessageBox.Discard
+                | QtGui.QMessageBox.Cancel,
+                QtGui.QMessageBox.Save)
+            if answer == QtGui.QMessageBox.Cancel:
+                event.ignore()
+                return
+            if answer == QtGui.QMessageBox.Save:
+                try:
+                    self.model.commit()
+                except (IOError, OSError) as e:
+                    QtGui.QMessageBox.critical(
+                        self, "Zebo", "Couldn't save '{}': {}".format(
+                            self.model.get_filename(), e))
+                    event.ignore()
+                    return
+
+        self.model.close_journal()
+        event.accept()
 
     def _previous(self):
-        prev_path = self.model.path_previous(self.navigator.currentPath())
-        if prev_path is None:
+        if self.cursor is None or self.cursor <= 0:
             return
-        self.navigator.setCurrentPath(prev_path)
+        self._move_to_row(self.cursor - 1)
 
     def _next(self):
-        next_path = self.model.path_next(self.navigator.currentPath())
-        if next_path is None:
+        if self.cursor is None or self.cursor + 1 >= self.model.row_count():
             return
-        self.navigator.setCurrentPath(next_path)
-
-    def _update_nav(self, path):
-        prev_path = self.model.path_previous(path)
-        self.prev_button.setEnabled(prev_path is not None)
+        self._move_to_row(self.cursor + 1)
 
-        next_path = self.model.path_next(path)
-        self.next_button.setEnabled(next_path is not None)
+    def _move_to_row(self, row_idx):
+        self.cursor = row_idx
+        self.navigator.setCurrentPath(self.model.path_at_row(row_idx))
 
-    def update(self):
-        if self.model.is_modified():
+    def _update_nav(self, path):
+        # Keep the cursor if it's still on the selected path, so that
+        # rows with the same path can be stepped through
+        if (self.cursor is None or self.cursor >= self.model.row_count()
+            or self.model.path_at_row(self.cursor) != path):
+            self.cursor = self.model.row_with_path(path)
+        self.editor.setCurrentPath(path, self.cursor)
+
+        self.prev_button.setEnabled(self.cursor is not None and
+                                    self.cursor > 0)
+        self.next_button.setEnabled(self.cursor is not None and
+                                    self.cursor + 1 < self.model.row_count())
+
+    def _update_modified(self, modified):
+        if modified:
             title = "{} [modified] - Zebo"
         else:
             title = "{} - Zebo"
         self.setWindowTitle(title.format(self.model.get_filename()))
 
+        self.save_button.setEnabled(modified and not self.model.is_busy())
+
+    def _update_history(self):
+        self.undo_button.setEnabled(self.model.can_undo())
+        self.redo_button.setEnabled(self.model.can_redo())
+
+    def _update_structure(self):
+        self.cursor = None
         self._update_nav(self.navigator.currentPath())
-        self.save_button.setEnabled(self.model.is_modified())
+
+    def update(self):
+        self._update_modified(self.model.is_modified())
+        self._update_history()
+        self._update_structure()
+
+class ProgressDialog(QtGui.QProgressDialog):
+    """Dialog showing the progress of a background load"""
+
+    def __init__(self, text, **kwargs):
+        super(ProgressDialog, self).__init__(**kwargs)
+
+        self.text = text
+        self.setWindowTitle("Zebo")
+        self.setLabelText(text)
+        self.setCancelButton(None)
+        self.setRange(0, 0)
+
+    def setProgress(self, stage, done, total):
+        self.setLabelText("{} ({})".format(self.text, stage))
+        self.setRange(0, total)
+        self.setValue(done)
+
+# Only has an effect if ZEBO_STATS is set
+instrument.instrument(NavigatorComboBox, ['update'])
+instrument.instrument(EditorDisplay, ['update'])
+instrument.instrument(EditorComboBox, ['update'])
+instrument.instrument(EditorWidget, ['updateVisible'])
+instrument.instrument(StatisticsWidget, ['update'])
+instrument.instrument(TopLevelWidget, ['_update_modified', '_update_nav',
+                                       '_update_history',
+                                       '_update_structure'])
 
 if __name__ == '__main__':
+    logging.basicConfig(format='%(message)s',
+                        level=os.environ.get('ZEBO_LOG', 'INFO').upper())
+
     app = QtGui.QApplication([])
 
     if len(sys.argv) < 2:
@@ -449,10 +902,53 @@ if __name__ == '__main__':
     if filename == '':
         sys.exit()
 
-    mdata = MeasurementsData(filename)
+    # Several files, or a glob pattern, are opened as one dataset
+    if len(sys.argv) > 2:
+        mdata = DatasetData(sys.argv[1:])
+    elif any(c in filename for c in '*?['):
+        mdata = DatasetData(filename)
+    else:
+        mdata = MeasurementsData(filename, journal=True)
+
+    # Load the file in the background, and only open the main window
+    # once it's ready
+    dialog = ProgressDialog("Loading '{}'".format(filename))
+    mdata.progress.connect(dialog.setProgress)
+
+    windows = []
+    def loaded(error):
+        mdata.progress.disconnect(dialog.setProgress)
+        dialog.close()
+
+        if error is not None:
+            QtGui.QMessageBox.critical(
+                None, "Zebo", "Couldn't load '{}': {}".format(filename, error))
+            app.exit(1)
+            return
+
+        # Offer to recover the edits from a session that crashed
+        if mdata.recoverable:
+            cells = sum(len(rows)
+                        for col_idx, value, rows in mdata.recoverable)
+            answer = QtGui.QMessageBox.question(
+                None, "Zebo", "'{}' has {} unsaved edits ({} cells) from a "
+                "previous session that didn't finish.  Recover them?"
+                .format(filename, len(mdata.recoverable), cells),
+                QtGui.QMessageBox.Yes | QtGui.QMessageBox.No,
+                QtGui.QMessageBox.Yes)
+            if answer == QtGui.QMessageBox.Yes:
+                mdata.recover()
+            else:
+                mdata.discard_recovery()
+
+        w = TopLevelWidget(model=mdata)
+        w.show()
+        windows.append(w)
+
+    mdata.loadFinished.connect(loaded)
+    mdata.load_async()
+    dialog.show()
 
-    w = TopLevelWidget(model=mdata)
-    w.show()
     sys.exit(app.exec_())
 
 # Local variables:
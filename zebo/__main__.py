@@ -0,0 +1,5 @@
+import sys
+
+from zebo.cli import main
+
+sys.exit(main())
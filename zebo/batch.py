@@ -0,0 +1,131 @@
+import os
+import shutil
+import tempfile
+
+from zebo import csvio
+from zebo.schema import Schema
+
+################################################################
+# Streaming batch edits
+################################################################
+
+def read_edits(fp, csv_format=csvio.DEFAULT_FORMAT):
+    """Read a list of edits from a CSV file opened in binary mode.
+
+    Each row holds a measurement key, a value, and then zero or more
+    metadata values making up the path prefix of the rows to set.
+    Returns a list of (path, key, value) tuples."""
+    edits = []
+    for line_no, row in enumerate(csv_format.reader(fp), 1):
+        if not row:
+            continue
+        if len(row) < 2:
+            raise ValueError("Edit {}: expected a key and a value"
+                             .format(line_no))
+        edits.append((row[2:], row[0], row[1]))
+    return edits
+
+class EditPlan(object):
+    """A list of edits, resolved against the header of a CSV file.
+
+    Edits are grouped by path prefix, so that the edits for a row are
+    found with one dict lookup per distinct prefix length."""
+
+    def __init__(self, header, edits):
+        schema = Schema(header)
+        self.key_cols = schema.key_cols
+
+        # Map of path prefix tuple to list of (sequence, column index,
+        # value).  The sequence number makes later edits win.
+        self.by_prefix = {}
+
+        for seq, (path, key, value) in enumerate(edits):
+            info = schema.measurement(key)
+            if info is None:
+                raise ValueError("No measurement column '{}'".format(key))
+            if not info.mutable:
+                raise ValueError("Measurement column '{}' is read-only"
+                                 .format(key))
+            if info.type is not None:
+                info.type.validate(value)
+            if len(path) > len(self.key_cols):
+                raise ValueError("Path {} is too long".format(path))
+
+            self.by_prefix.setdefault(tuple(path), []).append(
+                (seq, info.idx, value))
+
+        self.depths = sorted(set(len(prefix) for prefix in self.by_prefix))
+
+    def apply(self, row):
+        """Apply the matching edits to a row in place.
+
+        Returns True if any edits matched the row."""
+        path = tuple(row[col_idx] if col_idx < len(row) else ''
+                     for col_idx in self.key_cols)
+
+        matches = []
+        for depth in self.depths:
+            matches.extend(self.by_prefix.get(path[:depth], ()))
+        if not matches:
+            return False
+
+        matches.sort()
+        for seq, col_idx, value in matches:
+            while col_idx >= len(row):
+                row.append('')
+            row[col_idx] = value
+        return True
+
+def apply_edits(filename, edits, output=None):
+    """Apply a list of (path, key, value) edits to a CSV file.
+
+    The file is processed in a single streaming pass, so memory use
+    doesn't depend on its size.  Rows that no edit matches are copied
+    byte for byte, and changed rows are written in the file's own
+    encoding and dialect.  The result is written to `output`, or
+    replaces the original file if `output` is None.
+
+    Returns the number of rows read and the number of rows changed."""
+    if output is None:
+        output = filename
+
+    directory = os.path.dirname(os.path.abspath(output))
+    fd, temp_filename = tempfile.mkstemp(dir=directory, suffix='.tmp')
+
+    nrows = 0
+    changed = 0
+    try:
+        with os.fdopen(fd, 'wb') as out_fp:
+            with open(filename, 'rb') as in_fp:
+                csv_format = csvio.sniff_format(in_fp)
+                records = csvio.read_records(in_fp, csv_format)
+
+                # The first row should contain column names
+                data, header = next(records)
+                plan = EditPlan(header, edits)
+                out_fp.write(csv_format.bom)
+                out_fp.write(data)
+
+                for data, row in records:
+                    nrows += 1
+                    if plan.apply(row):
+                        changed += 1
+                        data = csv_format.format_row(
+                            row, csvio.row_terminator(data))
+                    out_fp.write(data)
+
+            csvio.sync_file(out_fp)
+
+        shutil.copymode(filename, temp_filename)
+        csvio.replace_file(temp_filename, output)
+    except:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
+
+    return nrows, changed
+
+# Local variables:
+# indent-tabs-mode: nil
+# tab-width: 4
+# End:
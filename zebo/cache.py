@@ -0,0 +1,250 @@
+import hashlib
+import json
+import os
+import struct
+import sys
+import tempfile
+from array import array
+
+from zebo import csvio
+from zebo.columns import Column
+from zebo.index import PathIndex
+
+################################################################
+# Binary table cache
+################################################################
+
+# The cache is kept next to the CSV file, in a file with this suffix
+# appended to the CSV file name
+CACHE_SUFFIX = '.zebo'
+CACHE_VERSION = 3
+
+# Cache files start with this, followed by the length of the JSON
+# header and the header itself
+CACHE_MAGIC = b'ZEBO'
+_HEADER_LENGTH = struct.Struct('<I')
+
+# Blocks sampled from the CSV file to fingerprint its contents
+FINGERPRINT_BLOCKS = 16
+FINGERPRINT_BLOCK_SIZE = 1 << 12
+
+def cache_filename(filename):
+    return filename + CACHE_SUFFIX
+
+def file_version(filename):
+    """Get the size, modification time and fingerprint of a file.
+
+    The fingerprint is a hash of blocks sampled evenly through the file,
+    so it can be computed without reading the whole file."""
+    with open(filename, 'rb') as in_fp:
+        return fp_version(in_fp)
+
+def fp_version(fp):
+    """Get the version of a file opened in binary mode, as for
+    file_version(), leaving its position unchanged.  This is the version
+    of the file that is open, even if it has since been replaced."""
+    pos = fp.tell()
+    st = os.fstat(fp.fileno())
+    digest = hashlib.md5()
+
+    span = max(0, st.st_size - FINGERPRINT_BLOCK_SIZE)
+    for i in range(FINGERPRINT_BLOCKS + 1):
+        fp.seek(span * i // FINGERPRINT_BLOCKS)
+        digest.update(fp.read(FINGERPRINT_BLOCK_SIZE))
+    fp.seek(pos)
+
+    return (st.st_size, st.st_mtime, digest.hexdigest())
+
+class CachedTable(object):
+    """Table contents loaded from a cache file"""
+
+    def __init__(self, offsets, columns, index):
+        # Byte offsets of the row boundaries in the CSV file
+        self.offsets = offsets
+
+        # Map of column index to Column
+        self.columns = columns
+
+        # PathIndex, or None if none was cached for the requested key
+        # columns
+        self.index = index
+
+# Values are bytes on Python 2 but text on Python 3.  JSON only holds
+# text, so bytes are stored as the Latin-1 text with the same code
+# points, which is lossless.
+if bytes is str:
+    def _to_json(values):
+        return [value.decode('latin-1') for value in values]
+
+    def _from_json(values):
+        return [value.encode('latin-1') for value in values]
+else:
+    def _to_json(values):
+        return values
+
+    def _from_json(values):
+        return values
+
+def _read_header(in_fp):
+    if in_fp.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+        return None
+    data = in_fp.read(_HEADER_LENGTH.size)
+    if len(data) != _HEADER_LENGTH.size:
+        return None
+    length, = _HEADER_LENGTH.unpack(data)
+    return json.loads(in_fp.read(length).decode('utf-8'))
+
+def read_cache(filename, file_version, col_indices=None, key_cols=None):
+    """Read the cached table for a CSV file.
+
+    Loads the columns listed in `col_indices`, or every column of the
+    table if it is None, and the path index if it was built from the
+    columns listed in `key_cols`.  Returns None if there is no cache,
+    if it wasn't written for the specified `file_version` of the file
+    (see file_version()), or if it doesn't hold the requested columns."""
+    try:
+        with open(cache_filename(filename), 'rb') as in_fp:
+            info = _read_header(in_fp)
+
+            if (info is None
+                or info.get('version') != CACHE_VERSION
+                or info['itemsize'] != [array('l').itemsize,
+                                        array('i').itemsize]
+                or info.get('python') != sys.version_info[0]
+                or info['file_version'] != list(file_version)):
+                return None
+
+            cached_cols = [col_idx for col_idx, values in info['columns']]
+            if col_indices is None:
+                if not info['complete']:
+                    return None
+                col_indices = cached_cols
+            elif not set(col_indices).issubset(cached_cols):
+                return None
+
+            nrows = info['nrows']
+            offsets = array('l')
+            offsets.fromfile(in_fp, nrows + 1)
+
+            # Column arrays are stored one after the other, so skip
+            # past any that weren't requested
+            wanted = set(col_indices)
+            columns = {}
+            for col_idx, values in info['columns']:
+                codes = array('i')
+                if col_idx in wanted:
+                    codes.fromfile(in_fp, nrows)
+                    columns[col_idx] = Column.restore(_from_json(values),
+                                                      codes)
+                else:
+                    in_fp.seek(nrows * codes.itemsize, os.SEEK_CUR)
+
+            index = None
+            if key_cols is not None and info['key_cols'] == list(key_cols):
+                rows = array('i')
+                rows.fromfile(in_fp, nrows)
+                codes = []
+                for labels in info['index_labels']:
+                    level_codes = array('i')
+                    level_codes.fromfile(in_fp, nrows)
+                    codes.append(level_codes)
+                index = PathIndex.restore([_from_json(labels) for labels
+                                           in info['index_labels']],
+                                          rows, codes)
+
+    except (IOError, OSError, EOFError, KeyError, TypeError, ValueError,
+            UnicodeError):
+        return None
+
+    return CachedTable(offsets, columns, index)
+
+def write_cache(filename, file_version, offsets, columns, complete=False,
+                index=None, key_cols=None):
+    """Write the cached table for a CSV file.
+
+    `file_version` is the version of the file that the table was read
+    from or written to (see file_version()).  `columns` maps column
+    indices to Columns, and `complete` says whether they make up the
+    whole table.  The path `index` may also be cached, along with the
+    list of `key_cols` it was built from."""
+    install_cache(filename, stage_cache(filename, file_version, offsets,
+                                        columns, complete, index, key_cols))
+
+def stage_cache(filename, file_version, offsets, columns, complete=False,
+                index=None, key_cols=None):
+    """Write the cached table for a CSV file to a new file, as for
+    write_cache(), to be moved into place by install_cache() or thrown
+    away by discard_cache().
+
+    Returns the name of the new file, or None if it couldn't be
+    written."""
+    nrows = len(offsets) - 1
+    col_indices = sorted(columns)
+
+    info = {'version': CACHE_VERSION,
+            'itemsize': [array('l').itemsize, array('i').itemsize],
+            # Values are bytes on Python 2 but text on Python 3
+            'python': sys.version_info[0],
+            'file_version': list(file_version),
+            'nrows': nrows,
+            'complete': complete,
+            'columns': [(col_idx, _to_json(columns[col_idx].values))
+                        for col_idx in col_indices],
+            'key_cols': None,
+            'index_labels': None}
+
+    if index is not None:
+        info['key_cols'] = list(key_cols)
+        info['index_labels'] = [_to_json(labels) for labels in index.labels]
+
+    header = json.dumps(info).encode('utf-8')
+
+    # The cache is only an optimisation, so failing to write it (e.g. in
+    # a read-only directory) isn't an error.  It's written to a new file
+    # which then replaces the old one, so a reader never sees it half
+    # written.
+    directory = os.path.dirname(os.path.abspath(filename))
+    try:
+        fd, temp_filename = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    except (IOError, OSError):
+        return None
+
+    try:
+        with os.fdopen(fd, 'wb') as out_fp:
+            out_fp.write(CACHE_MAGIC)
+            out_fp.write(_HEADER_LENGTH.pack(len(header)))
+            out_fp.write(header)
+            offsets.tofile(out_fp)
+            for col_idx in col_indices:
+                columns[col_idx].codes.tofile(out_fp)
+
+            if index is not None:
+                index.rows.tofile(out_fp)
+                for codes in index.codes:
+                    codes.tofile(out_fp)
+    except (IOError, OSError):
+        discard_cache(temp_filename)
+        return None
+    return temp_filename
+
+def install_cache(filename, staged):
+    """Replace the cache of a CSV file with a file written by
+    stage_cache(), if there is one"""
+    if staged is None:
+        return
+    try:
+        csvio.replace_file(staged, cache_filename(filename))
+    except (IOError, OSError):
+        discard_cache(staged)
+
+def discard_cache(staged):
+    """Remove a file written by stage_cache()"""
+    try:
+        os.remove(staged)
+    except OSError:
+        pass
+
+# Local variables:
+# indent-tabs-mode: nil
+# tab-width: 4
+# End:
@@ -0,0 +1,112 @@
+import argparse
+import csv
+import sys
+import time
+
+from zebo import batch, export, instrument
+
+################################################################
+# Command line interface
+################################################################
+
+def _binary(stream):
+    # Standard streams are text on Python 3, with the bytes underneath
+    return getattr(stream, 'buffer', stream)
+
+def _cmd_set(args):
+    if args.edits == '-':
+        edits = batch.read_edits(_binary(sys.stdin))
+    else:
+        with open(args.edits, 'rb') as in_fp:
+            edits = batch.read_edits(in_fp)
+
+    start = time.time()
+    nrows, changed = batch.apply_edits(args.csv_file, edits, args.output)
+    elapsed = max(time.time() - start, 1e-6)
+
+    sys.stderr.write("{} rows read, {} rows changed in {:.2f}s "
+                     "({:.0f} rows/sec)\n"
+                     .format(nrows, changed, elapsed, nrows / elapsed))
+
+def _split_list(text):
+    # Lists on the command line are comma separated, quoted as in CSV.
+    # An empty string is an empty list, e.g. the prefix of every row.
+    return next(csv.reader([text]), [])
+
+def _cmd_export(args):
+    prefixes = [_split_list(prefix) for prefix in args.prefix or []]
+    columns = None
+    if args.columns is not None:
+        columns = _split_list(args.columns)
+
+    start = time.time()
+    if args.output is None:
+        nrows = export.export_rows(args.csv_file, _binary(sys.stdout),
+                                   prefixes, columns)
+    else:
+        with open(args.output, 'wb') as out_fp:
+            nrows = export.export_rows(args.csv_file, out_fp, prefixes,
+                                       columns)
+    elapsed = max(time.time() - start, 1e-6)
+
+    sys.stderr.write("{} rows written in {:.2f}s\n".format(nrows, elapsed))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='zebo', description="Edit zebo CSV files without the GUI")
+    parser.set_defaults(func=None)
+    parser.add_argument('--profile', metavar='FILE',
+                        help="write a cProfile/pstats dump to FILE on exit")
+    subparsers = parser.add_subparsers(title='commands')
+
+    set_parser = subparsers.add_parser(
+        'set', help="set measurement values",
+        description="Set measurement values in a CSV file.  Each row of "
+        "EDITS is 'KEY,VALUE,PATH...', where PATH is zero or more "
+        "metadata values; every row whose path starts with PATH has its "
+        "KEY column set to VALUE.  Later edits take precedence.")
+    set_parser.add_argument('csv_file', metavar='CSV_FILE')
+    set_parser.add_argument('edits', metavar='EDITS', nargs='?', default='-',
+                            help="CSV file of edits (default: standard input)")
+    set_parser.add_argument('-o', '--output', metavar='FILE',
+                            help="write the result to FILE instead of "
+                            "replacing CSV_FILE")
+    set_parser.set_defaults(func=_cmd_set)
+
+    export_parser = subparsers.add_parser(
+        'export', help="extract rows by path prefix",
+        description="Write the rows of a CSV file whose path starts with "
+        "any of the given prefixes, with the header.  Each PREFIX is a "
+        "comma separated list of metadata values.")
+    export_parser.add_argument('csv_file', metavar='CSV_FILE')
+    export_parser.add_argument('-p', '--prefix', metavar='PREFIX',
+                               action='append',
+                               help="select rows under PREFIX (may be "
+                               "repeated; default: all rows)")
+    export_parser.add_argument('-c', '--columns', metavar='NAMES',
+                               help="comma separated list of the columns "
+                               "to write (default: all columns)")
+    export_parser.add_argument('-o', '--output', metavar='FILE',
+                               help="write to FILE instead of standard "
+                               "output")
+    export_parser.set_defaults(func=_cmd_export)
+
+    args = parser.parse_args(argv)
+    if args.func is None:
+        parser.print_usage()
+        return 2
+
+    if args.profile:
+        instrument.enable(profile=args.profile)
+
+    try:
+        args.func(args)
+    except (ValueError, IOError, OSError) as e:
+        sys.stderr.write("zebo: {}\n".format(e))
+        return 1
+    return 0
+
+# Local variables:
+# indent-tabs-mode: nil
+# tab-width: 4
+# End:
@@ -0,0 +1,386 @@
+from array import array
+from collections import Counter
+from itertools import compress, count
+from operator import itemgetter, ne
+
+################################################################
+# Column-oriented table storage
+################################################################
+
+# Code stored for cells that are beyond the end of a short row
+MISSING = -1
+
+class Column(object):
+    """A dictionary-encoded column of string values.
+
+    Each distinct value is stored once in `values`; the cells of the
+    column are stored as a compact array of integer codes into it."""
+
+    def __init__(self, nrows=0):
+        self.values = []
+        self.lookup = {}
+        self.codes = array('i', [MISSING]) * nrows
+
+    @classmethod
+    def restore(cls, values, codes):
+        """Rebuild a column from its distinct values and code array"""
+        column = cls()
+        column.values = values
+        column.lookup = dict((value, code)
+                             for code, value in enumerate(values))
+        column.codes = codes
+        return column
+
+    def __len__(self):
+        return len(self.codes)
+
+    def encode(self, value):
+        code = self.lookup.get(value)
+        if code is None:
+            code = len(self.values)
+            self.values.append(value)
+            self.lookup[value] = code
+        return code
+
+    def append(self, value):
+        self.codes.append(self.encode(value))
+
+    def append_missing(self):
+        self.codes.append(MISSING)
+
+    def append_values(self, values):
+        """Append a list of cells, encoding each distinct value once"""
+        lookup = self.lookup
+        for value in dict.fromkeys(values):
+            if value not in lookup:
+                self.encode(value)
+        self.codes.extend(array('i', map(lookup.__getitem__, values)))
+
+    def append_missing_rows(self, nrows):
+        self.codes.extend(array('i', [MISSING]) * nrows)
+
+    def extend(self, values, codes):
+        """Append cells given as codes into another list of distinct
+        values, recoding them into this column's values"""
+        remap = array('i', [self.encode(value) for value in values])
+        remap.append(MISSING)
+        self.codes.extend(array('i', map(remap.__getitem__, codes)))
+
+    def is_missing(self, row_idx):
+        return self.codes[row_idx] == MISSING
+
+    def get(self, row_idx):
+        code = self.codes[row_idx]
+        if code == MISSING:
+            return ''
+        return self.values[code]
+
+    def set(self, row_idx, value):
+        self.codes[row_idx] = self.encode(value)
+
+    def distinct_values(self, row_indices):
+        """Get the set of distinct values in the specified rows"""
+        codes = set(map(self.codes.__getitem__, row_indices))
+        return set(self.values[code] if code != MISSING else ''
+                   for code in codes)
+
+    def code_counts(self, row_indices):
+        """Get a map of code to the number of the specified rows with it"""
+        return Counter(map(self.codes.__getitem__, row_indices))
+
+    def value_counts(self, row_indices):
+        """Get a map of value to the number of the specified rows with it"""
+        result = {}
+        for code, count in self.code_counts(row_indices).items():
+            value = self.values[code] if code != MISSING else ''
+            result[value] = result.get(value, 0) + count
+        return result
+
+    def set_rows(self, row_indices, value):
+        code = self.encode(value)
+        codes = self.codes
+        for row_idx in row_indices:
+            codes[row_idx] = code
+
+    def changed_rows(self, other):
+        """Get the indices of the rows where another column of the same
+        length has a different value, with missing cells read as empty"""
+        # Recode the other column into this one's values, so that most
+        # cells are compared as codes without looking at their strings.
+        # Values that this column doesn't have get a code that never
+        # matches.
+        remap = array('i', [self.lookup.get(value, MISSING - 1)
+                            for value in other.values])
+        remap.append(MISSING)
+        codes = array('i', map(remap.__getitem__, other.codes))
+        if codes == self.codes:
+            return []
+
+        candidates = compress(count(), map(ne, codes, self.codes))
+        return [row_idx for row_idx in candidates
+                if self.get(row_idx) != other.get(row_idx)]
+
+class TypedColumn(Column):
+    """Column of a declared type, which also holds each distinct value
+    converted to a float by its ColumnType.  Each value is only parsed
+    when it's first seen, so cells can be compared and aggregated
+    without handling their strings again."""
+
+    def __init__(self, ctype, nrows=0):
+        Column.__init__(self, nrows)
+        self.ctype = ctype
+        self.numbers = array('d')
+
+    @classmethod
+    def from_column(cls, column, ctype):
+        """Make a typed column sharing the values and codes of a Column"""
+        typed = cls(ctype)
+        typed.values = column.values
+        typed.lookup = column.lookup
+        typed.codes = column.codes
+        typed.numbers = array('d', map(ctype.parse, column.values))
+        return typed
+
+    def encode(self, value):
+        code = self.lookup.get(value)
+        if code is None:
+            code = Column.encode(self, value)
+            self.numbers.append(self.ctype.parse(value))
+        return code
+
+    def number_counts(self, row_indices):
+        """Get (converted value, number of rows) pairs for the distinct
+        values of the specified rows"""
+        numbers = self.numbers + array('d', [float('nan')])
+        return [(numbers[code], count)
+                for code, count in self.code_counts(row_indices).items()]
+
+class ColumnStore(object):
+    """Table of string cells stored as one Column per CSV column.
+
+    Rows may be shorter than the table is wide; the missing cells read
+    back as empty strings, and rows are written out at their original
+    width unless a cell beyond the end of the row has been set."""
+
+    def __init__(self, ncols=0):
+        self.columns = [Column() for x in range(ncols)]
+        self.nrows = 0
+
+        # Byte offsets of the row boundaries in the file
+        self.offsets = None
+
+    @classmethod
+    def from_columns(cls, columns, nrows, ncols=0):
+        """Build a table from a list of Columns of `nrows` cells each"""
+        store = cls()
+        store.columns = columns
+        store.nrows = nrows
+        store._widen(ncols)
+        return store
+
+    def __len__(self):
+        return self.nrows
+
+    def _widen(self, ncols):
+        while len(self.columns) < ncols:
+            self.columns.append(Column(self.nrows))
+
+    def append_row(self, row):
+        self._widen(len(row))
+
+        for col_idx, column in enumerate(self.columns):
+            if col_idx < len(row):
+                column.append(row[col_idx])
+            else:
+                column.append_missing()
+
+        self.nrows += 1
+
+    def column(self, col_idx):
+        return self.columns[col_idx]
+
+    def get(self, row_idx, col_idx):
+        if col_idx >= len(self.columns):
+            return ''
+        return self.columns[col_idx].get(row_idx)
+
+    def set(self, row_idx, col_idx, value):
+        self._widen(col_idx + 1)
+        self.columns[col_idx].set(row_idx, value)
+
+    def set_rows(self, row_indices, col_idx, value):
+        """Set one column of several rows to the same value"""
+        self._widen(col_idx + 1)
+        self.columns[col_idx].set_rows(row_indices, value)
+
+    def distinct_values(self, row_indices, col_indices):
+        """Get the set of distinct values in each of the listed columns,
+        over the specified rows"""
+        result = []
+        for col_idx in col_indices:
+            if col_idx < len(self.columns):
+                result.append(
+                    self.columns[col_idx].distinct_values(row_indices))
+            elif len(row_indices):
+                result.append(set(['']))
+            else:
+                result.append(set())
+        return result
+
+    def value_counts(self, row_indices, col_idx):
+        """Get a map of each value in a column to the number of the
+        specified rows with it"""
+        if col_idx < len(self.columns):
+            return self.columns[col_idx].value_counts(row_indices)
+        elif len(row_indices):
+            return {'': len(row_indices)}
+        return {}
+
+    def row(self, row_idx):
+        """Get the cells of the specified row, as a list of strings"""
+        width = len(self.columns)
+        while width > 0 and self.columns[width - 1].is_missing(row_idx):
+            width -= 1
+
+        return [self.columns[col_idx].get(row_idx) for col_idx in range(width)]
+
+    def rows(self):
+        for row_idx in range(self.nrows):
+            yield self.row(row_idx)
+
+    def release(self):
+        """Release the file before it is rewritten"""
+        pass
+
+    def saved(self, offsets, dirty_rows=()):
+        """Notify the store that its rows have been written to the file,
+        apart from edits to the rows in `dirty_rows`"""
+        self.offsets = offsets
+
+class ColumnBuilder(object):
+    """Builds Columns from rows, either one at a time or in runs of rows
+    of the same width.
+
+    Holds either every column, or just those listed in `col_indices`."""
+
+    def __init__(self, col_indices=None):
+        self.col_indices = col_indices
+        if col_indices is None:
+            self.store = ColumnStore()
+        else:
+            self.columns = [Column() for col_idx in col_indices]
+        self.nrows = 0
+
+        # Every row is wanted
+        self.done = False
+
+    def append_row(self, row):
+        if self.col_indices is None:
+            self.store.append_row(row)
+        else:
+            for column, col_idx in zip(self.columns, self.col_indices):
+                if col_idx < len(row):
+                    column.append(row[col_idx])
+                else:
+                    column.append_missing()
+        self.nrows += 1
+
+    def append_rows(self, rows, width):
+        """Append a list of rows that all have `width` cells"""
+        if self.col_indices is None:
+            store = self.store
+            store._widen(width)
+            if width:
+                cells = list(zip(*rows))
+            for col_idx, column in enumerate(store.columns):
+                if col_idx < width:
+                    column.append_values(cells[col_idx])
+                else:
+                    column.append_missing_rows(len(rows))
+            store.nrows += len(rows)
+        else:
+            for column, col_idx in zip(self.columns, self.col_indices):
+                if col_idx < width:
+                    column.append_values(list(map(itemgetter(col_idx), rows)))
+                else:
+                    column.append_missing_rows(len(rows))
+        self.nrows += len(rows)
+
+    def result(self):
+        """Get the list of Columns and the number of rows"""
+        if self.col_indices is None:
+            return self.store.columns, self.store.nrows
+        return self.columns, self.nrows
+
+class ColumnDiffer(object):
+    """Compares rows, given in the same way as to a ColumnBuilder, with
+    the cells of a list of Columns of `nrows` cells each, and collects
+    the cells that differ.  Missing cells compare as empty.
+
+    Comparing stops once the rows no longer line up, i.e. there are more
+    of them or a cell in one of the `key_cols` differs."""
+
+    def __init__(self, columns, nrows, key_cols=()):
+        self.columns = columns
+        self.length = nrows
+        self.key_cols = list(key_cols)
+        self.nrows = 0
+
+        # Set once the rows no longer line up
+        self.done = False
+
+        # The values of each column, indexed by code, with an empty
+        # value at the end for the MISSING code to pick up
+        self.values = [column.values + [''] for column in columns]
+
+        # List of (row index, column index, value) for the cells that
+        # differ, in row order within each column and run of rows
+        self.changes = []
+
+    def _old_cells(self, col_idx, start, end):
+        if col_idx < len(self.columns):
+            codes = self.columns[col_idx].codes[start:end]
+            return tuple(map(self.values[col_idx].__getitem__, codes))
+        return ('',) * (end - start)
+
+    def append_row(self, row):
+        self.append_rows([row], len(row))
+
+    def append_rows(self, rows, width):
+        """Compare a list of rows that all have `width` cells"""
+        start = self.nrows
+        end = self.nrows = start + len(rows)
+        if end > self.length:
+            self.done = True
+        if self.done:
+            return
+
+        cells = list(zip(*rows)) if width else []
+        key_cols = self.key_cols
+        others = [col_idx for col_idx in range(max(width, len(self.columns)))
+                  if col_idx not in key_cols]
+        for col_idx in key_cols + others:
+            if col_idx < width:
+                new = cells[col_idx]
+            else:
+                new = ('',) * len(rows)
+            old = self._old_cells(col_idx, start, end)
+            if new == old:
+                continue
+            if col_idx in key_cols:
+                self.done = True
+                return
+            for offset in compress(count(), map(ne, new, old)):
+                self.changes.append((start + offset, col_idx, new[offset]))
+
+    def result(self):
+        """Get the list of changed cells, or None if the rows don't line
+        up with the columns"""
+        if self.done or self.nrows != self.length:
+            return None
+        return self.changes
+
+# Local variables:
+# indent-tabs-mode: nil
+# tab-width: 4
+# End:
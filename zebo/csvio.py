@@ -0,0 +1,401 @@
+import codecs
+import csv
+import io
+import os
+from array import array
+
+from zebo.columns import ColumnBuilder
+
+################################################################
+# CSV file access with row byte offsets
+################################################################
+
+# Size of the blocks used when copying unchanged parts of a file
+BLOCK_SIZE = 1 << 20
+
+# Amount of the start of a file used to guess its format
+SNIFF_SIZE = 64 << 10
+
+# Number of rows used to guess the delimiter, and the delimiters that
+# are recognised, in order of preference
+SNIFF_ROWS = 20
+DELIMITERS = ',;\t|'
+
+# The csv module reads and writes bytes on Python 2, but text on
+# Python 3
+_TEXT = bytes is not str
+
+class CSVFormat(object):
+    """Encoding and dialect of a CSV file, and the reader and writer
+    for it.
+
+    Files are always accessed in binary mode so that rows can be found
+    by byte offset.  On Python 3 cells are decoded to text, with bytes
+    that aren't valid in `encoding` kept as lone surrogates so that they
+    are written back unchanged; on Python 2 they're left as bytes.  The
+    encoding must be ASCII compatible.  `bom` is the byte order mark at
+    the start of the file, if any.
+
+    Unless `fast` is cleared, blocks of rows without any quotes are
+    split directly rather than by the csv module, which is several times
+    faster."""
+
+    def __init__(self, encoding='utf-8', delimiter=',', bom=b'', fast=True):
+        self.encoding = encoding
+        self.delimiter = delimiter
+        self.bom = bom
+        self.fast = fast
+
+    def __eq__(self, other):
+        return (isinstance(other, CSVFormat)
+                and (self.encoding, self.delimiter, self.bom)
+                == (other.encoding, other.delimiter, other.bom))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def decode(self, data):
+        if _TEXT:
+            return data.decode(self.encoding, 'surrogateescape')
+        return data
+
+    def encode(self, text):
+        if _TEXT:
+            return text.encode(self.encoding, 'surrogateescape')
+        return text
+
+    def reader(self, lines):
+        """Get a csv reader for an iterable of lines of bytes"""
+        if _TEXT:
+            lines = map(self.decode, lines)
+        return csv.reader(lines, delimiter=self.delimiter)
+
+    def writer(self, fp, terminator='\r\n'):
+        """Get a csv writer for a file opened in binary mode, and the
+        wrapper around the file that counts the bytes written"""
+        out = _EncodingWriter(fp, self)
+        return csv.writer(out, delimiter=self.delimiter,
+                          lineterminator=_text(terminator)), out
+
+    def format_row(self, row, terminator='\r\n'):
+        """Get the bytes of a single CSV row"""
+        buf = io.BytesIO()
+        csv_writer, out = self.writer(buf, terminator)
+        csv_writer.writerow(row)
+        return buf.getvalue()
+
+    def read_columns(self, fp, offsets, col_indices=None):
+        """Parse the rest of a CSV file opened in binary mode into
+        Columns, holding either every column or just those listed in
+        `col_indices`.
+
+        The row offsets are appended to `offsets` as for read_rows(),
+        but the file is read in large blocks, and blocks without quotes
+        are split directly.  Returns a list of Columns and the number
+        of rows."""
+        return self.parse(fp, offsets, ColumnBuilder(col_indices)).result()
+
+    def parse(self, fp, offsets, builder):
+        """Parse the rest of a CSV file opened in binary mode in large
+        blocks, passing the rows to `builder`, which is a ColumnBuilder
+        or anything else with the same append_row() and append_rows()
+        methods and `done` attribute.  Parsing stops early once `done`
+        is set.  Returns `builder`."""
+        pos = fp.tell()
+        pending = b''
+        while not builder.done:
+            data = fp.read(BLOCK_SIZE)
+            at_end = not data
+            data = pending + data
+            if not data:
+                break
+
+            # Blocks must end at a row boundary.  A newline only ends a
+            # row if it follows an even number of quotes, as escaped
+            # quotes are doubled.
+            if at_end:
+                end = len(data)
+            else:
+                end = data.rfind(b'\n') + 1
+                if end == 0 or data.count(b'"', 0, end) % 2:
+                    pending = data
+                    continue
+            block = data[:end]
+            pending = data[end:]
+
+            if not (self.fast and self._split_block(block, pos, offsets,
+                                                    builder)):
+                source = _LineSource(io.BytesIO(block))
+                for row in self.reader(source):
+                    offsets.append(pos + source.pos)
+                    builder.append_row(row)
+            pos += len(block)
+
+        return builder
+
+    def _split_block(self, block, pos, offsets, builder):
+        # Split a block of whole rows without any quotes.  Returns False
+        # without doing anything if the block needs the csv module, e.g.
+        # because it has quotes, blank rows or bare carriage returns.
+        if b'"' in block:
+            return False
+        crlf = block.count(b'\r')
+        if crlf and crlf != block.count(b'\r\n'):
+            return False
+
+        text = self.decode(block)
+        if crlf:
+            text = text.replace('\r\n', '\n')
+        lines = text.split('\n')
+        terminated = not lines[-1]
+        if terminated:
+            lines.pop()
+        if '' in lines:
+            return False
+
+        # Row offsets are counted in bytes, and only multi-byte
+        # characters make them differ from the lengths of the lines
+        if crlf or len(text) != len(block):
+            lengths = map(len, block.split(b'\n'))
+        else:
+            lengths = map(len, lines)
+        for length in lengths:
+            pos += length + 1
+            offsets.append(pos)
+        if not terminated:
+            offsets[-1] -= 1
+        elif crlf or len(text) != len(block):
+            # The split bytes also have an empty line after the last
+            # newline
+            offsets.pop()
+
+        delimiter = self.delimiter
+        rows = [line.split(delimiter) for line in lines]
+        widths = set(map(len, rows))
+        if len(widths) == 1:
+            builder.append_rows(rows, widths.pop())
+        else:
+            for row in rows:
+                builder.append_row(row)
+        return True
+
+DEFAULT_FORMAT = CSVFormat()
+
+def _text(terminator):
+    # Line terminators may be given as the bytes of a row's ending
+    if _TEXT and isinstance(terminator, bytes):
+        return terminator.decode('ascii')
+    return terminator
+
+def _sniff_delimiter(lines):
+    # Prefer a delimiter that splits every row into the same number of
+    # cells, and otherwise the first one found in the header
+    for delimiter in DELIMITERS:
+        try:
+            widths = set(len(row) for row in
+                         csv.reader(lines, delimiter=delimiter) if row)
+        except csv.Error:
+            continue
+        if len(widths) == 1 and widths.pop() > 1:
+            return delimiter
+
+    for delimiter in DELIMITERS:
+        if lines and delimiter in lines[0]:
+            return delimiter
+    return ','
+
+def sniff_format(fp):
+    """Guess the CSVFormat of a file opened in binary mode, from its
+    byte order mark and first few rows.
+
+    Leaves the file positioned at the start of the header row."""
+    start = fp.tell()
+    sample = fp.read(SNIFF_SIZE)
+    truncated = len(sample) == SNIFF_SIZE
+
+    bom = b''
+    if sample.startswith(codecs.BOM_UTF8):
+        bom = codecs.BOM_UTF8
+        sample = sample[len(bom):]
+
+    # Only whole lines are used, unless the sample has no newlines
+    if truncated and b'\n' in sample:
+        sample = sample[:sample.rindex(b'\n') + 1]
+
+    # Files are read as UTF-8 unless their start isn't valid UTF-8
+    encoding = 'utf-8'
+    try:
+        sample.decode(encoding)
+    except UnicodeDecodeError as e:
+        # A character may have been cut off at the end of the sample
+        if e.end < len(sample) or not truncated:
+            encoding = 'latin-1'
+
+    csv_format = CSVFormat(encoding, ',', bom)
+    lines = csv_format.decode(sample).splitlines(True)[:SNIFF_ROWS]
+    csv_format.delimiter = _sniff_delimiter(lines)
+
+    fp.seek(start + len(bom))
+    return csv_format
+
+class _LineSource(object):
+    """Iterate over the lines of a binary file, tracking the byte offset"""
+
+    def __init__(self, fp, keep_lines=False):
+        self.fp = fp
+        self.pos = fp.tell()
+
+        # Lines read since the list was last cleared, if requested
+        self.lines = [] if keep_lines else None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.fp.readline()
+        if not line:
+            raise StopIteration
+        self.pos += len(line)
+        if self.lines is not None:
+            self.lines.append(line)
+        return line
+
+    next = __next__
+
+class _EncodingWriter(object):
+    """File wrapper that encodes what the csv module writes to it, and
+    tracks the number of bytes written through it"""
+
+    def __init__(self, fp, csv_format):
+        self.fp = fp
+        self.csv_format = csv_format
+        self.pos = fp.tell()
+
+    def write(self, data):
+        data = self.csv_format.encode(data)
+        self.fp.write(data)
+        self.pos += len(data)
+
+def read_rows(fp, offsets, csv_format=DEFAULT_FORMAT):
+    """Generate the rows of a CSV file opened in binary mode.
+
+    The byte offset of the end of each row is appended to `offsets` as
+    the row is read.  The csv module only ever consumes whole lines, so
+    a row's end offset is also the start offset of the next row."""
+    source = _LineSource(fp)
+    for row in csv_format.reader(source):
+        offsets.append(source.pos)
+        yield row
+
+def read_records(fp, csv_format=DEFAULT_FORMAT):
+    """Generate the rows of a CSV file opened in binary mode.
+
+    Yields (data, row) tuples, where `data` holds the raw bytes of the
+    row so that it can be copied to another file unchanged."""
+    source = _LineSource(fp, keep_lines=True)
+    for row in csv_format.reader(source):
+        data = b''.join(source.lines)
+        del source.lines[:]
+        yield data, row
+
+def row_terminator(data):
+    """Get the line ending of the raw bytes of a row"""
+    if data.endswith(b'\r\n'):
+        return b'\r\n'
+    elif data.endswith(b'\n') or data.endswith(b'\r'):
+        return data[-1:]
+    return b''
+
+def write_rows(fp, rows, offsets, csv_format=DEFAULT_FORMAT):
+    """Write rows to a CSV file opened in binary mode.
+
+    The byte offset of the end of each row is appended to `offsets`."""
+    csv_writer, out = csv_format.writer(fp)
+    for row in rows:
+        csv_writer.writerow(row)
+        offsets.append(out.pos)
+
+def format_row(row, terminator='\r\n', csv_format=DEFAULT_FORMAT):
+    """Get the bytes of a single CSV row"""
+    return csv_format.format_row(row, terminator)
+
+def _row_terminator(fp, start, end):
+    fp.seek(max(start, end - 2))
+    return row_terminator(fp.read(end - fp.tell()))
+
+def copy_range(src, dst, start, end):
+    src.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        data = src.read(min(remaining, BLOCK_SIZE))
+        if not data:
+            break
+        dst.write(data)
+        remaining -= len(data)
+
+def copy_patched(src, dst, offsets, rows, csv_format=DEFAULT_FORMAT):
+    """Copy a CSV file, replacing some of its rows.
+
+    `offsets` must hold the byte offsets of the row boundaries in `src`,
+    as built by read_rows() or write_rows().  `rows` maps row indices,
+    counting from the first row after the header, to the new cells for
+    that row.  Everything else is copied in blocks without parsing it,
+    and replacement rows keep their original line endings.  The rows
+    are written in `csv_format`.
+
+    Returns the byte offsets of the row boundaries in `dst`."""
+    new_offsets = array('l', offsets)
+    patches = sorted(rows)
+
+    pos = 0
+    delta = 0
+    for count, row_idx in enumerate(patches):
+        start, end = offsets[row_idx], offsets[row_idx + 1]
+        data = csv_format.format_row(rows[row_idx],
+                                     _row_terminator(src, start, end))
+
+        copy_range(src, dst, pos, start)
+        dst.write(data)
+        pos = end
+
+        # Shift the boundaries up to the next replaced row
+        delta += len(data) - (end - start)
+        if delta != 0:
+            if count + 1 < len(patches):
+                next_row = patches[count + 1]
+            else:
+                next_row = len(offsets) - 1
+            for boundary in range(row_idx + 1, next_row + 1):
+                new_offsets[boundary] += delta
+
+    copy_range(src, dst, pos, offsets[-1])
+    return new_offsets
+
+def sync_file(fp):
+    """Make sure that the data written to a file is on disk"""
+    fp.flush()
+    os.fsync(fp.fileno())
+
+def replace_file(src, dst):
+    """Atomically rename a file over another one"""
+    # os.replace() isn't available on Python 2, where os.rename() can't
+    # overwrite an existing file on Windows
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        if os.name == 'nt' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+    # Make sure that the rename itself is on disk
+    if os.name == 'posix':
+        fd = os.open(os.path.dirname(os.path.abspath(dst)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+# Local variables:
+# indent-tabs-mode: nil
+# tab-width: 4
+# End:
@@ -0,0 +1,378 @@
+import glob
+import logging
+import os
+from bisect import bisect_right
+from collections import OrderedDict
+
+from zebo import cache, csvio
+from zebo.columns import Column
+from zebo.history import HISTORY_LIMIT
+from zebo.index import PathIndex
+from zebo.model import (LoadedFile, Measurements, cache_enabled, read_table,
+                        write_patched)
+
+# Number of shards whose rows are kept loaded, unless specified otherwise
+RESIDENT_SHARDS = 8
+
+log = logging.getLogger(__name__)
+
+################################################################
+# Datasets of several CSV files
+################################################################
+
+class Shard(object):
+    """One CSV file of a dataset"""
+
+    def __init__(self, filename, base, offsets, file_version, csv_format):
+        self.filename = filename
+        self.csv_format = csv_format
+
+        # Index of the shard's first row in the dataset
+        self.base = base
+
+        # Byte offsets of the row boundaries in the file, and its
+        # version (see cache.file_version()) when they were found
+        self.offsets = offsets
+        self.file_version = file_version
+
+        # Table holding the shard's rows, or None if it isn't loaded
+        self.table = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+class ShardedStore(object):
+    """Table made up of the rows of several CSV files in turn.
+
+    The key columns of every shard are held in memory, merged into one
+    Column each.  The rest of a shard is only loaded when its rows are
+    accessed, and only the `resident` most recently used shards are
+    kept loaded, along with any that have unsaved edits."""
+
+    def __init__(self, shards, keys, mapped=None, workers=None,
+                 resident=RESIDENT_SHARDS, cache=None):
+        self.shards = shards
+        self.bases = [shard.base for shard in shards]
+        self.nrows = sum(len(shard) for shard in shards)
+
+        # Map of column index to merged Column for the key columns
+        self.keys = keys
+
+        self.mapped = mapped
+        self.workers = workers
+        self.resident = resident
+        self.cache = cache
+
+        # Map of index to loaded shard, least recently used first
+        self.lru = OrderedDict()
+
+        # Indices of the shards with unsaved edits
+        self.modified = set()
+
+    def __len__(self):
+        return self.nrows
+
+    def locate(self, row_idx):
+        """Get the index of the shard holding a row, and the row's index
+        within the shard"""
+        shard_idx = bisect_right(self.bases, row_idx) - 1
+        return shard_idx, row_idx - self.bases[shard_idx]
+
+    def split(self, row_indices):
+        """Get a map of shard index to the shard's rows among
+        `row_indices`, as indices within the shard"""
+        result = {}
+        for row_idx in row_indices:
+            shard_idx, local_idx = self.locate(row_idx)
+            result.setdefault(shard_idx, []).append(local_idx)
+        return result
+
+    def table(self, shard_idx):
+        """Get the table of a shard, loading it if necessary"""
+        shard = self.shards[shard_idx]
+        if shard.table is None:
+            shard.table = self._load(shard)
+        self.lru.pop(shard_idx, None)
+        self.lru[shard_idx] = shard
+        self._evict()
+        return shard.table
+
+    def _load(self, shard):
+        # The dataset's index and offsets are only valid for the file
+        # as it was when the dataset was loaded
+        if cache.file_version(shard.filename) != shard.file_version:
+            raise IOError("'{}' has been changed since it was loaded"
+                          .format(shard.filename))
+        log.debug("Loading shard '%s'", shard.filename)
+        return read_table(shard.filename, self.mapped, self.cache,
+                          self.workers, csv_format=shard.csv_format).table
+
+    def _evict(self):
+        # Never evict the most recently used shard, or any with edits
+        while len(self.lru) > self.resident:
+            candidates = [shard_idx for shard_idx in list(self.lru)[:-1]
+                          if shard_idx not in self.modified]
+            if not candidates:
+                return
+            shard = self.lru.pop(candidates[0])
+            shard.table.release()
+            shard.table = None
+
+    def column(self, col_idx):
+        return self.keys[col_idx]
+
+    def get(self, row_idx, col_idx):
+        column = self.keys.get(col_idx)
+        if column is not None:
+            return column.get(row_idx)
+
+        shard_idx, local_idx = self.locate(row_idx)
+        return self.table(shard_idx).get(local_idx, col_idx)
+
+    def row(self, row_idx):
+        shard_idx, local_idx = self.locate(row_idx)
+        return self.table(shard_idx).row(local_idx)
+
+    def rows(self):
+        for shard_idx, shard in enumerate(self.shards):
+            for local_idx in range(len(shard)):
+                yield self.table(shard_idx).row(local_idx)
+
+    def distinct_values(self, row_indices, col_indices):
+        result = [set() for col_idx in col_indices]
+        for shard_idx, local_rows in self.split(row_indices).items():
+            shard_values = self.table(shard_idx).distinct_values(local_rows,
+                                                                 col_indices)
+            for values, more in zip(result, shard_values):
+                values.update(more)
+        return result
+
+    def value_counts(self, row_indices, col_idx):
+        column = self.keys.get(col_idx)
+        if column is not None:
+            return column.value_counts(row_indices)
+
+        result = {}
+        for shard_idx, local_rows in self.split(row_indices).items():
+            counts = self.table(shard_idx).value_counts(local_rows, col_idx)
+            for value, count in counts.items():
+                result[value] = result.get(value, 0) + count
+        return result
+
+    def set(self, row_idx, col_idx, value):
+        self.set_rows([row_idx], col_idx, value)
+
+    def set_rows(self, row_indices, col_idx, value):
+        for shard_idx, local_rows in self.split(row_indices).items():
+            self.modified.add(shard_idx)
+            self.table(shard_idx).set_rows(local_rows, col_idx, value)
+
+    def replace_shard(self, shard_idx, temp_filename, offsets, dirty_rows):
+        """Rename a rewritten copy of a shard over it.  `dirty_rows`
+        lists the shard's rows that still have unsaved edits."""
+        shard = self.shards[shard_idx]
+
+        shard.table.release()
+        try:
+            version = cache.file_version(temp_filename)
+            csvio.replace_file(temp_filename, shard.filename)
+        except:
+            shard.table.saved(shard.offsets, dirty_rows)
+            raise
+
+        shard.table.saved(offsets, dirty_rows)
+        shard.offsets = offsets
+        shard.file_version = version
+
+    def release(self):
+        for shard in self.lru.values():
+            shard.table.release()
+            shard.table = None
+        self.lru.clear()
+
+class Dataset(Measurements):
+    """Measurements data model for several CSV files with the same
+    header, presented as one table with the files' rows in turn.
+
+    `filenames` is a list of files, or a glob pattern that is expanded
+    in sorted order each time the dataset is loaded.  Saving only
+    rewrites the files with edits; each file is replaced atomically,
+    but a failure part way through may leave some files saved."""
+
+    def __init__(self, filenames, mapped=None, workers=None, cache=None,
+                 resident=RESIDENT_SHARDS, history_limit=HISTORY_LIMIT,
+                 csv_format=None):
+        if isinstance(filenames, (list, tuple)):
+            self.filenames = list(filenames)
+            name = self.filenames[0]
+            if len(self.filenames) > 1:
+                name += " (+{} files)".format(len(self.filenames) - 1)
+        else:
+            self.filenames = None
+            name = filenames
+
+        Measurements.__init__(self, name, mapped=mapped, workers=workers,
+                              cache=cache, history_limit=history_limit,
+                              csv_format=csv_format)
+        self.resident = resident
+
+    def _expand(self):
+        if self.filenames is not None:
+            return self.filenames
+        return sorted(glob.glob(self.filename))
+
+    def _read_file(self):
+        filenames = self._expand()
+        if not filenames:
+            raise IOError("No files match '{}'".format(self.filename))
+
+        col_titles = None
+        keys = None
+        shards = []
+        nrows = 0
+
+        for count, filename in enumerate(filenames):
+            self._emit_progress('Reading', count, len(filenames) + 1)
+
+            # Only the key columns are needed up front, which is what
+            # the mapped backend loads.  The shard is only cached if it
+            # would be when opened on its own, as the mapped backend
+            # otherwise always caches.
+            use_cache = cache_enabled(filename, self.cache, self.mapped)
+            loaded = read_table(filename, True, use_cache, self.workers,
+                                csv_format=self.format_override)
+            loaded.table.release()
+
+            if col_titles is None:
+                col_titles = loaded.col_titles
+                keys = dict((col_idx, Column())
+                            for col_idx in loaded.schema.key_cols)
+            elif loaded.col_titles != col_titles:
+                raise ValueError("'{}' doesn't have the same columns as '{}'"
+                                 .format(filename, filenames[0]))
+
+            for col_idx, column in keys.items():
+                shard_column = loaded.table.column(col_idx)
+                column.extend(shard_column.values, shard_column.codes)
+
+            shards.append(Shard(filename, nrows, loaded.table.offsets,
+                                loaded.file_version, loaded.csv_format))
+            nrows += len(loaded.table)
+
+        self._emit_progress('Indexing', len(filenames), len(filenames) + 1)
+        key_cols = sorted(keys)
+        index = PathIndex([keys[col_idx] for col_idx in key_cols], nrows)
+        table = ShardedStore(shards, keys, self.mapped, self.workers,
+                             self.resident, self.cache)
+
+        self._emit_progress('Loaded', len(filenames) + 1, len(filenames) + 1)
+        return LoadedFile(col_titles, table, index, None,
+                          shards[0].csv_format)
+
+    def _dirty_shards(self, dirty_cells):
+        return set(self.table.locate(row_idx)[0] for row_idx in dirty_cells)
+
+    def _can_save_changes(self, committed=None):
+        # Only files that haven't been changed by anything else can be
+        # saved, including those being saved by a commit in progress
+        shards = self._dirty_shards(self.dirty_cells)
+        if committed is not None:
+            shards |= self._dirty_shards(committed)
+        for shard_idx in sorted(shards):
+            shard = self.table.shards[shard_idx]
+            try:
+                if cache.file_version(shard.filename) != shard.file_version:
+                    return False
+            except (IOError, OSError):
+                return False
+        return True
+
+    def _should_patch(self, committed):
+        # Only the shards with modified rows are rewritten anyway
+        return True
+
+    def _check_file(self, overwrite=False):
+        # Changes to the files aren't merged, as the key columns of every
+        # shard would need to be kept in step, and the files can't be
+        # rewritten in full like a single file either
+        if not self._can_save_changes():
+            raise IOError("Files of '{}' have been changed since they were "
+                          "loaded".format(self.filename))
+        return True, None
+
+    def _write_changes(self, rows):
+        by_shard = {}
+        for row_idx, cells in rows.items():
+            shard_idx, local_idx = self.table.locate(row_idx)
+            by_shard.setdefault(shard_idx, {})[local_idx] = cells
+
+        written = []
+        try:
+            for count, shard_idx in enumerate(sorted(by_shard)):
+                self._emit_progress('Writing', count, len(by_shard))
+                shard = self.table.shards[shard_idx]
+                temp_filename, offsets = write_patched(
+                    shard.filename, shard.offsets, by_shard[shard_idx],
+                    shard.csv_format)
+                written.append((shard_idx, temp_filename, offsets))
+        except:
+            self._discard_changes(written)
+            raise
+
+        self._emit_progress('Saved', len(by_shard), len(by_shard))
+        return written
+
+    def _discard_changes(self, written):
+        for shard_idx, temp_filename, offsets in written:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+
+    def _local_rows(self, shard_idx, dirty_cells):
+        shard = self.table.shards[shard_idx]
+        return set(row_idx - shard.base for row_idx in dirty_cells
+                   if self.table.locate(row_idx)[0] == shard_idx)
+
+    def _finish_commit(self, written, committed):
+        table = self.table
+        for count, (shard_idx, temp_filename, offsets) in enumerate(written):
+            dirty_rows = self._local_rows(shard_idx, self.dirty_cells)
+            try:
+                table.replace_shard(shard_idx, temp_filename, offsets,
+                                    dirty_rows
+                                    | self._local_rows(shard_idx, committed))
+            except:
+                # The edits to this shard and the ones after it still
+                # need to be saved
+                self._discard_changes(written[count:])
+                unsaved = set(idx for idx, temp_filename, offsets
+                              in written[count:])
+                self._abort_commit(committed.subset(
+                    row_idx for row_idx in committed
+                    if table.locate(row_idx)[0] in unsaved))
+                table.modified = self._dirty_shards(self.dirty_cells)
+                self._committed()
+                raise
+
+        table.modified = self._dirty_shards(self.dirty_cells)
+        log.info("Saved %d rows to %d files of '%s'", len(committed),
+                 len(written), self.filename)
+        self._committed()
+
+    def _cache_jobs(self, written):
+        # Keep the cache of each saved shard up to date, along with its
+        # own path index, so that the dataset can be loaded again
+        # quickly.  Shards with edits made since the commit began are
+        # left alone.
+        jobs = []
+        for shard_idx, temp_filename, offsets in written:
+            shard = self.table.shards[shard_idx]
+            if (not self._local_rows(shard_idx, self.dirty_cells)
+                and cache_enabled(shard.filename, self.cache, self.mapped)):
+                jobs.append((shard.filename, shard.file_version, shard.table,
+                             None))
+        return jobs
+
+# Local variables:
+# indent-tabs-mode: nil
+# tab-width: 4
+# End:
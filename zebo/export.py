@@ -0,0 +1,129 @@
+import itertools
+
+from zebo import cache, csvio
+from zebo.schema import Schema
+
+################################################################
+# Streaming export of rows by path prefix
+################################################################
+
+class RowFilter(object):
+    """A list of path prefixes and columns, resolved against the header
+    of a CSV file in `csv_format`"""
+
+    def __init__(self, header, prefixes=None, columns=None,
+                 csv_format=csvio.DEFAULT_FORMAT):
+        self.csv_format = csv_format
+
+        schema = Schema(header)
+        self.key_cols = schema.key_cols
+
+        # An empty prefix matches every row
+        if not prefixes:
+            prefixes = [[]]
+        for path in prefixes:
+            if len(path) > len(self.key_cols):
+                raise ValueError("Path {} is too long".format(path))
+        self.prefixes = set(tuple(path) for path in prefixes)
+        self.depths = sorted(set(len(prefix) for prefix in self.prefixes))
+
+        # Indices of the columns to keep, or None to keep whole rows
+        self.col_indices = None
+        if columns is not None:
+            self.col_indices = []
+            for name in columns:
+                info = schema.column(name)
+                if info is None:
+                    raise ValueError("No column '{}'".format(name))
+                self.col_indices.append(info.idx)
+
+    def matches(self, row):
+        path = tuple(row[col_idx] if col_idx < len(row) else ''
+                     for col_idx in self.key_cols)
+        for depth in self.depths:
+            if path[:depth] in self.prefixes:
+                return True
+        return False
+
+    def project(self, row):
+        return [row[col_idx] if col_idx < len(row) else ''
+                for col_idx in self.col_indices]
+
+    def write(self, out_fp, data, row):
+        """Write a row, copying its raw bytes if all its columns are kept"""
+        if self.col_indices is None:
+            out_fp.write(data)
+        else:
+            out_fp.write(self.csv_format.format_row(
+                self.project(row), csvio.row_terminator(data)))
+
+def _row_ranges(row_indices):
+    """Group sorted row indices into (first, last + 1) runs"""
+    ranges = []
+    for row_idx in row_indices:
+        if ranges and ranges[-1][1] == row_idx:
+            ranges[-1][1] += 1
+        else:
+            ranges.append([row_idx, row_idx + 1])
+    return ranges
+
+def _export_indexed(in_fp, out_fp, row_filter, cached):
+    row_indices = set()
+    for prefix in row_filter.prefixes:
+        row_indices.update(cached.index.row_indices(prefix))
+
+    offsets = cached.offsets
+    count = 0
+    for first, last in _row_ranges(sorted(row_indices)):
+        if row_filter.col_indices is None:
+            csvio.copy_range(in_fp, out_fp, offsets[first], offsets[last])
+        else:
+            in_fp.seek(offsets[first])
+            records = csvio.read_records(in_fp, row_filter.csv_format)
+            for data, row in itertools.islice(records, last - first):
+                row_filter.write(out_fp, data, row)
+        count += last - first
+    return count
+
+def _export_scan(records, out_fp, row_filter):
+    count = 0
+    for data, row in records:
+        if row_filter.matches(row):
+            row_filter.write(out_fp, data, row)
+            count += 1
+    return count
+
+def export_rows(filename, out_fp, prefixes=None, columns=None):
+    """Write the rows of a CSV file with any of the specified path
+    prefixes to `out_fp`, which must be open in binary mode.
+
+    `columns` lists the names of the columns to write, in order; by
+    default, rows are copied unchanged.  The header is always written,
+    and the output has the same encoding and dialect as the file.
+    If the file has an up to date cache with a path index, only the
+    matching ranges of the file are read; otherwise, the file is
+    scanned once with constant memory.
+
+    Returns the number of rows written."""
+    with open(filename, 'rb') as in_fp:
+        file_version = cache.fp_version(in_fp)
+        csv_format = csvio.sniff_format(in_fp)
+        records = csvio.read_records(in_fp, csv_format)
+
+        # The first row should contain column names
+        data, header = next(records)
+        row_filter = RowFilter(header, prefixes, columns, csv_format)
+        out_fp.write(csv_format.bom)
+        row_filter.write(out_fp, data, header)
+
+        cached = cache.read_cache(filename, file_version, [],
+                                  row_filter.key_cols)
+        if cached is not None and cached.index is not None:
+            return _export_indexed(in_fp, out_fp, row_filter, cached)
+
+        return _export_scan(records, out_fp, row_filter)
+
+# Local variables:
+# indent-tabs-mode: nil
+# tab-width: 4
+# End:
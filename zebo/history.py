@@ -0,0 +1,170 @@
+from array import array
+
+from zebo.columns import Column
+
+################################################################
+# Undo and redo
+################################################################
+
+# Number of cell changes kept for undoing and redoing, unless specified
+# otherwise
+HISTORY_LIMIT = 1 << 20
+
+class CellDelta(object):
+    """Change of one measurement column over several rows.
+
+    The previous values are dictionary-encoded like a Column, so a bulk
+    edit costs a few bytes per row however many rows it covers."""
+
+    def __init__(self, path, key, col_idx, rows, old, new):
+        # Path prefix that the edit was made under, for invalidating
+        # summaries
+        self.path = path
+        self.key = key
+        self.col_idx = col_idx
+
+        # Array of the edited row indices, a Column of their previous
+        # values in the same order, and the value they were all set to
+        self.rows = rows
+        self.old = old
+        self.new = new
+
+    def __len__(self):
+        return len(self.rows)
+
+    def old_rows(self):
+        """Get a map of each previous value to the array of rows that
+        had it"""
+        by_code = {}
+        for row_idx, code in zip(self.rows, self.old.codes):
+            rows = by_code.get(code)
+            if rows is None:
+                rows = by_code[code] = array('i')
+            rows.append(row_idx)
+        return dict((self.old.values[code], rows)
+                    for code, rows in by_code.items())
+
+    def remap(self, moved):
+        """Renumber the rows after the table has been reloaded.  `moved`
+        maps old to new row indices, and rows missing from it are
+        dropped."""
+        rows = array('i')
+        codes = array('i')
+        for row_idx, code in zip(self.rows, self.old.codes):
+            new_idx = moved.get(row_idx)
+            if new_idx is not None:
+                rows.append(new_idx)
+                codes.append(code)
+        self.rows = rows
+        self.old = Column.restore(self.old.values, codes)
+
+class EditHistory(object):
+    """Undo and redo stacks of edits.
+
+    Each step is a list of CellDeltas made together, by one edit or one
+    batch of edits.  Once the steps hold more than `limit` cell changes
+    in total, the oldest are forgotten."""
+
+    def __init__(self, limit=HISTORY_LIMIT):
+        self.limit = limit
+        self.undo_steps = []
+        self.redo_steps = []
+
+        # Number of cell changes held by both stacks
+        self.size = 0
+
+        # Step being built while a batch of edits is open
+        self.pending = None
+
+    def clear(self):
+        self.undo_steps = []
+        self.redo_steps = []
+        self.size = 0
+        self.pending = None
+
+    def begin(self):
+        self.pending = []
+
+    def end(self):
+        step = self.pending
+        self.pending = None
+        if step:
+            self._push(step)
+
+    def record(self, delta):
+        # A new edit can't be followed by the steps that were undone
+        for step in self.redo_steps:
+            self.size -= self._cells(step)
+        del self.redo_steps[:]
+
+        if self.pending is not None:
+            self.pending.append(delta)
+        else:
+            self._push([delta])
+
+    def _cells(self, step):
+        return sum(len(delta) for delta in step)
+
+    def _push(self, step):
+        self.undo_steps.append(step)
+        self.size += self._cells(step)
+
+        while self.size > self.limit and self.undo_steps:
+            self.size -= self._cells(self.undo_steps.pop(0))
+
+    def rows(self):
+        """Get the set of row indices that the steps change"""
+        result = set()
+        for step in self.undo_steps + self.redo_steps + [self.pending or []]:
+            for delta in step:
+                result.update(delta.rows)
+        return result
+
+    def remap(self, moved):
+        """Renumber the rows of every step, as for CellDelta.remap().
+        Steps left without any rows are forgotten."""
+        for steps in (self.undo_steps, self.redo_steps):
+            for step in steps:
+                for delta in step:
+                    delta.remap(moved)
+                step[:] = [delta for delta in step if len(delta)]
+            steps[:] = [step for step in steps if step]
+        if self.pending is not None:
+            for delta in self.pending:
+                delta.remap(moved)
+            self.pending[:] = [delta for delta in self.pending if len(delta)]
+
+        self.size = sum(self._cells(step)
+                        for step in self.undo_steps + self.redo_steps)
+
+    def can_undo(self):
+        return bool(self.undo_steps)
+
+    def can_redo(self):
+        return bool(self.redo_steps)
+
+    def undo(self):
+        """Move the most recent step to the redo stack, and return it"""
+        step = self.undo_steps.pop()
+        self.redo_steps.append(step)
+        return step
+
+    def redo(self):
+        """Move the most recently undone step back to the undo stack,
+        and return it"""
+        step = self.redo_steps.pop()
+        self.undo_steps.append(step)
+        return step
+
+def make_delta(table, path, key, col_idx, row_indices, value):
+    """Record the current values of a column over some rows of a table,
+    before they're all set to `value`"""
+    old = Column()
+    for row_idx in row_indices:
+        old.append(table.get(row_idx, col_idx))
+    return CellDelta(path, key, col_idx, array('i', row_indices), old, value)
+
+# Local variables:
+# indent-tabs-mode: nil
+# tab-width: 4
+# End:
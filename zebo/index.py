@@ -0,0 +1,149 @@
+from array import array
+from bisect import bisect_left, bisect_right
+
+################################################################
+# Path index
+################################################################
+
+class PathIndex(object):
+    """Sorted index from metadata paths to table row indices.
+
+    Entries are sorted by metadata path, so the rows sharing any path
+    prefix occupy one contiguous range of the index.  Each level of the
+    path is stored as an array of value ranks, which lets a prefix be
+    resolved by bisecting one level at a time within the range found
+    for the previous level."""
+
+    def __init__(self, columns, nrows):
+        self.depth = len(columns)
+
+        # Per level: the distinct values in sorted order, and the rank
+        # of each value in that order
+        self.labels = []
+        self.ranks = []
+
+        # Rank of every row's value at each level, in table row order
+        row_ranks = []
+
+        for column in columns:
+            labels = sorted(set(column.values + ['']))
+            ranks = dict((value, rank) for rank, value in enumerate(labels))
+
+            # Map column codes to ranks.  The extra trailing entry is
+            # picked up by the MISSING code (-1) for cells beyond the
+            # end of short rows, which read back as ''.
+            remap = array('i', [ranks[value] for value in column.values])
+            remap.append(ranks[''])
+
+            self.labels.append(labels)
+            self.ranks.append(ranks)
+            row_ranks.append(array('i', map(remap.__getitem__, column.codes)))
+
+        # Sort the rows by path, one level at a time starting from the
+        # deepest.  The sort is stable, so rows with equal paths remain
+        # in table order.
+        order = list(range(nrows))
+        for ranks in reversed(row_ranks):
+            order.sort(key=ranks.__getitem__)
+
+        self.rows = array('i', order)
+        self.codes = [array('i', map(ranks.__getitem__, order))
+                      for ranks in row_ranks]
+
+    @classmethod
+    def restore(cls, labels, rows, codes):
+        """Rebuild an index from its sorted labels and entry arrays"""
+        index = cls.__new__(cls)
+        index.depth = len(labels)
+        index.labels = labels
+        index.ranks = [dict((value, rank) for rank, value in enumerate(level))
+                       for level in labels]
+        index.rows = rows
+        index.codes = codes
+        return index
+
+    def __len__(self):
+        return len(self.rows)
+
+    def find(self, path):
+        """Get the range of index entries with the specified path prefix.
+
+        Returns a (start, end) tuple, or None if no rows match."""
+        if len(path) > self.depth:
+            return None
+
+        lo, hi = 0, len(self.rows)
+        for level, element in enumerate(path):
+            rank = self.ranks[level].get(element)
+            if rank is None:
+                return None
+
+            codes = self.codes[level]
+            lo = bisect_left(codes, rank, lo, hi)
+            hi = bisect_right(codes, rank, lo, hi)
+            if lo == hi:
+                return None
+
+        return lo, hi
+
+    def row_index(self, path):
+        """Get the table row for a full path, or None"""
+        if len(path) != self.depth:
+            return None
+
+        found = self.find(path)
+        if found is None:
+            return None
+
+        # If several rows share the same path, the last one wins
+        return self.rows[found[1] - 1]
+
+    def row_indices(self, prefix):
+        """Get the table rows with the specified path prefix"""
+        found = self.find(prefix)
+        if found is None:
+            return array('i')
+        return self.rows[found[0]:found[1]]
+
+    def children(self, prefix):
+        """Get the distinct values at the level below a path prefix"""
+        found = self.find(prefix)
+        if found is None or len(prefix) == self.depth:
+            return []
+
+        lo, hi = found
+        level = len(prefix)
+        codes = self.codes[level]
+        labels = self.labels[level]
+
+        # Skip over each run of equal values in turn
+        values = []
+        while lo < hi:
+            rank = codes[lo]
+            values.append(labels[rank])
+            lo = bisect_right(codes, rank, lo, hi)
+        return values
+
+    def path_at(self, pos):
+        """Get the path of the entry at the specified index position"""
+        return [self.labels[level][self.codes[level][pos]]
+                for level in range(self.depth)]
+
+    def paths(self, prefix):
+        """Generate the distinct full paths with the specified prefix"""
+        found = self.find(prefix)
+        if found is None:
+            return
+
+        lo, hi = found
+        for pos in range(lo, hi):
+            # Entries with equal paths are adjacent
+            if pos > lo and all(codes[pos] == codes[pos - 1]
+                                for codes in self.codes):
+                continue
+            yield self.path_at(pos)
+
+# Local variables:
+# indent-tabs-mode: nil
+# tab-width: 4
+# End:
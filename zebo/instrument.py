@@ -0,0 +1,110 @@
+import atexit
+import cProfile
+import functools
+import os
+import sys
+import time
+import types
+
+################################################################
+# Call statistics and profiling
+################################################################
+
+# If set, call statistics are written to this file ('-' for standard
+# error) when the program exits
+STATS_ENV = 'ZEBO_STATS'
+
+# If set, a cProfile/pstats dump is written to this file when the
+# program exits
+PROFILE_ENV = 'ZEBO_PROFILE'
+
+# Map of call name to [number of calls, total seconds, longest call
+# in seconds], or None if call statistics are disabled
+_stats = None
+
+_profiler = None
+
+# time.perf_counter() isn't available on Python 2
+_clock = getattr(time, 'perf_counter', time.time)
+
+def enable(stats=None, profile=None):
+    """Start recording call statistics and/or profiling.
+
+    `stats` is the file to write call statistics to at exit, or '-' for
+    standard error.  `profile` is the file to write a pstats dump to at
+    exit.  Classes must be instrumented after statistics are enabled."""
+    global _stats, _profiler
+
+    if stats and _stats is None:
+        _stats = {}
+        atexit.register(write_stats, stats)
+
+    if profile and _profiler is None:
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+        atexit.register(_write_profile, profile)
+
+def _wrap(name, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = _clock()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = _clock() - start
+            record = _stats.get(name)
+            if record is None:
+                record = _stats[name] = [0, 0.0, 0.0]
+            record[0] += 1
+            record[1] += elapsed
+            record[2] = max(record[2], elapsed)
+    return wrapper
+
+def instrument(cls, names=None):
+    """Record call statistics for methods of a class.
+
+    `names` lists the methods to record; by default, every public method
+    defined by the class itself is recorded.  If call statistics aren't
+    enabled, the class is left untouched so there is no overhead."""
+    if _stats is None:
+        return cls
+
+    if names is None:
+        names = [name for name in vars(cls) if not name.startswith('_')]
+
+    for name in names:
+        func = vars(cls).get(name)
+        if isinstance(func, types.FunctionType):
+            setattr(cls, name, _wrap(cls.__name__ + '.' + name, func))
+    return cls
+
+def report():
+    """Get the call statistics as a list of lines of text"""
+    lines = ["{:<44} {:>8} {:>10} {:>10} {:>10}".format(
+        'Call', 'Count', 'Total s', 'Mean ms', 'Max ms')]
+
+    for name, (calls, total, longest) in sorted(
+            _stats.items(), key=lambda item: item[1][1], reverse=True):
+        lines.append("{:<44} {:>8} {:>10.3f} {:>10.3f} {:>10.3f}".format(
+            name, calls, total, 1000 * total / calls, 1000 * longest))
+
+    return lines
+
+def write_stats(filename):
+    text = '\n'.join(report()) + '\n'
+    if filename == '-':
+        sys.stderr.write(text)
+    else:
+        with open(filename, 'w') as out_fp:
+            out_fp.write(text)
+
+def _write_profile(filename):
+    _profiler.disable()
+    _profiler.dump_stats(filename)
+
+enable(os.environ.get(STATS_ENV), os.environ.get(PROFILE_ENV))
+
+# Local variables:
+# indent-tabs-mode: nil
+# tab-width: 4
+# End:
@@ -0,0 +1,281 @@
+import csv
+import itertools
+import os
+import re
+import socket
+import time
+from array import array
+
+from zebo import csvio
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+################################################################
+# Write-ahead journal of edits
+################################################################
+
+# Each session editing a file keeps its own journal next to the file,
+# named after the file and the session with this suffix.  A session
+# holds a lock on its journal's lock file for as long as it's running.
+JOURNAL_SUFFIX = '.journal'
+LOCK_SUFFIX = '.lock'
+JOURNAL_VERSION = '1'
+
+# Seconds between syncing the journal to disk.  Each edit is written to
+# the operating system as it's made, so it survives the program
+# crashing; syncing only guards against the system crashing too.
+SYNC_INTERVAL = 1.0
+
+# Sessions are named after the host and process, and numbered within
+# the process.  Names never contain '.', so the journals of one file
+# can't be mistaken for those of another.
+_sessions = itertools.count()
+
+def _new_session():
+    host = re.sub(r'[^A-Za-z0-9_-]', '_', socket.gethostname())
+    return '{}-{}-{}'.format(host, os.getpid(), next(_sessions))
+
+def journal_filename(filename, session):
+    return '{}.{}{}'.format(filename, session, JOURNAL_SUFFIX)
+
+def _journals(filename):
+    # List the journals of a file, oldest first
+    directory = os.path.dirname(os.path.abspath(filename))
+    pattern = re.compile(re.escape(os.path.basename(filename))
+                         + r'\.[A-Za-z0-9_-]+' + re.escape(JOURNAL_SUFFIX)
+                         + '$')
+    journals = [os.path.join(directory, name)
+                for name in os.listdir(directory) if pattern.match(name)]
+
+    def mtime(journal):
+        try:
+            return os.path.getmtime(journal)
+        except OSError:
+            return 0
+    return sorted(journals, key=mtime)
+
+def _try_lock(journal):
+    """Lock a journal for this session.  Returns the open lock file, or
+    None if another session holds the lock."""
+    lock_fp = open(journal + LOCK_SUFFIX, 'ab')
+    try:
+        if fcntl is not None:
+            fcntl.flock(lock_fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(lock_fp.fileno(), msvcrt.LK_NBLCK, 1)
+    except (IOError, OSError):
+        lock_fp.close()
+        return None
+    return lock_fp
+
+def _unlock(journal, lock_fp, remove):
+    # The journal is removed while it's still locked, so that no other
+    # session can claim it in between.  Windows can't remove a file
+    # that's open, so the lock file is closed first.
+    try:
+        if remove:
+            if os.path.exists(journal):
+                os.remove(journal)
+            if os.name != 'nt':
+                os.remove(journal + LOCK_SUFFIX)
+    finally:
+        lock_fp.close()
+    if remove and os.name == 'nt':
+        try:
+            os.remove(journal + LOCK_SUFFIX)
+        except OSError:
+            pass
+
+def _encode_rows(row_indices):
+    # Runs of consecutive rows are written as 'first-last'
+    runs = []
+    first = last = None
+    for row_idx in row_indices:
+        if last is not None and row_idx == last + 1:
+            last = row_idx
+            continue
+        if first is not None:
+            runs.append((first, last))
+        first = last = row_idx
+    if first is not None:
+        runs.append((first, last))
+
+    return ' '.join(str(first) if first == last
+                    else '{}-{}'.format(first, last)
+                    for first, last in runs)
+
+def _decode_rows(text):
+    rows = array('i')
+    for run in text.split():
+        first, sep, last = run.partition('-')
+        if sep:
+            rows.extend(range(int(first), int(last) + 1))
+        else:
+            rows.append(int(first))
+    return rows
+
+def _header(file_version):
+    size, mtime, fingerprint = file_version
+    return ['zebo-journal', JOURNAL_VERSION, str(size), repr(mtime),
+            fingerprint]
+
+def read_journal(journal, file_version):
+    """Read the edits in a journal file.
+
+    Returns a list of (column index, value, rows) tuples in the order
+    the edits were made, where `rows` is an array of row indices.
+    Returns None if the journal can't be read, or if it was started for
+    another version of the file (see cache.file_version()).  An edit
+    that was only partly written when the journal was last used is
+    ignored."""
+    edits = []
+    try:
+        with open(journal, 'rb') as in_fp:
+            records = csvio.read_records(in_fp)
+            data, header = next(records, (None, None))
+            if header != _header(file_version):
+                return None
+
+            for data, row in records:
+                if not data.endswith(b'\n'):
+                    break
+                if len(row) != 4 or row[0] != 'set':
+                    raise ValueError("Unknown journal record")
+                edits.append((int(row[1]), row[2], _decode_rows(row[3])))
+    except (IOError, OSError, ValueError, csv.Error):
+        return None
+    return edits
+
+class Recovery(object):
+    """The journals of a CSV file left behind by sessions that are no
+    longer running, e.g. because they crashed.
+
+    The journals are claimed by locking them, so that no other session
+    recovers them as well, until release() is called."""
+
+    def __init__(self, filename, file_version):
+        # (journal file name, lock file) for each claimed journal
+        self.claimed = []
+
+        # Edits from the journals that were started for `file_version`
+        # of the file, oldest first, as for read_journal()
+        self.edits = []
+
+        for journal in _journals(filename):
+            try:
+                lock_fp = _try_lock(journal)
+            except (IOError, OSError):
+                continue
+            if lock_fp is None:
+                continue
+            self.claimed.append((journal, lock_fp))
+
+            # The session may have finished between listing and locking
+            # its journal, which is then gone
+            self.edits.extend(read_journal(journal, file_version) or [])
+
+    def release(self, remove=False):
+        """Unlock the claimed journals, removing them if the edits in them
+        are no longer needed.  That includes any journals for other
+        versions of the file, which can't be recovered."""
+        for journal, lock_fp in self.claimed:
+            try:
+                _unlock(journal, lock_fp, remove)
+            except (IOError, OSError):
+                pass
+        self.claimed = []
+
+class Journal(object):
+    """Append-only log of the cell edits made to a CSV file by this
+    session since it was last loaded or saved.
+
+    The journal starts with the version of the file it applies to, so
+    that it's only replayed over the same file.  It's created with a
+    snapshot of `edits`, as for read_journal(), and locked until it's
+    closed."""
+
+    def __init__(self, filename, file_version, edits=()):
+        self.filename = journal_filename(filename, _new_session())
+        self.fp = None
+
+        self.lock_fp = _try_lock(self.filename)
+        if self.lock_fp is None:
+            raise IOError("'{}' is in use".format(self.filename))
+
+        try:
+            self.restart(file_version, edits)
+        except:
+            _unlock(self.filename, self.lock_fp, remove=True)
+            self.lock_fp = None
+            raise
+
+    def restart(self, file_version, edits=()):
+        """Replace the journal with one for `file_version` of the file
+        holding a snapshot of `edits`.  The journal stays locked."""
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
+        # The snapshot replaces the previous journal atomically, so
+        # there's always one to recover from
+        temp_filename = self.filename + '.tmp'
+        try:
+            with open(temp_filename, 'wb') as out_fp:
+                out_fp.write(csvio.format_row(_header(file_version)))
+                for col_idx, value, row_indices in edits:
+                    out_fp.write(self._record(col_idx, value, row_indices))
+                csvio.sync_file(out_fp)
+            csvio.replace_file(temp_filename, self.filename)
+        except:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            raise
+
+        self.fp = open(self.filename, 'ab')
+
+        # Whether edits have been written since the journal was last
+        # synced, and when that was
+        self.unsynced = False
+        self.synced_at = time.time()
+
+    def _record(self, col_idx, value, row_indices):
+        return csvio.format_row(['set', str(col_idx), value,
+                                 _encode_rows(row_indices)])
+
+    def append(self, col_idx, value, row_indices):
+        """Record that a column of some rows has been set to `value`"""
+        self.fp.write(self._record(col_idx, value, row_indices))
+        self.fp.flush()
+        self.unsynced = True
+
+        if time.time() - self.synced_at >= SYNC_INTERVAL:
+            self.sync()
+
+    def sync(self):
+        """Make sure that the edits written so far are on disk"""
+        if self.unsynced:
+            csvio.sync_file(self.fp)
+            self.unsynced = False
+        self.synced_at = time.time()
+
+    def close(self, remove=False):
+        """Close and unlock the journal, removing its file if the edits
+        in it are no longer needed"""
+        if self.lock_fp is None:
+            return
+        if self.fp is not None:
+            if not remove:
+                self.sync()
+            self.fp.close()
+            self.fp = None
+        _unlock(self.filename, self.lock_fp, remove)
+        self.lock_fp = None
+
+# Local variables:
+# indent-tabs-mode: nil
+# tab-width: 4
+# End:
@@ -0,0 +1,139 @@
+import mmap
+
+from zebo import csvio
+
+################################################################
+# Memory-mapped table storage
+################################################################
+
+class MappedStore(object):
+    """Table of string cells parsed on demand from a memory-mapped file.
+
+    Only the byte offsets of the row boundaries and the key columns
+    used to build the path index are held in memory.  Other cells are
+    parsed from the file when their row is requested, and edited rows
+    are held in memory until they are written back to the file."""
+
+    def __init__(self, filename, offsets, keys,
+                 csv_format=csvio.DEFAULT_FORMAT):
+        self.filename = filename
+        self.csv_format = csv_format
+
+        # Byte offsets of the row boundaries in the file, and a map of
+        # column index to Column for the key columns
+        self.offsets = offsets
+        self.keys = keys
+
+        # Map of row index to the cells of the edited row
+        self.edits = {}
+
+        self.mmap = None
+        self.cached_row = (None, None)
+
+        self._map()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _map(self):
+        with open(self.filename, 'rb') as in_fp:
+            self.mmap = mmap.mmap(in_fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self.cached_row = (None, None)
+
+    def _parse(self, row_idx):
+        start, end = self.offsets[row_idx], self.offsets[row_idx + 1]
+        lines = self.mmap[start:end].splitlines(True)
+        for row in self.csv_format.reader(lines):
+            return row
+        return []
+
+    def column(self, col_idx):
+        return self.keys[col_idx]
+
+    def row(self, row_idx):
+        """Get the cells of the specified row, as a list of strings"""
+        cells = self.edits.get(row_idx)
+        if cells is not None:
+            return cells
+
+        # Editors tend to request every cell of one row in turn, so
+        # keep the most recently parsed row
+        cached_idx, cells = self.cached_row
+        if cached_idx != row_idx:
+            cells = self._parse(row_idx)
+            self.cached_row = (row_idx, cells)
+        return cells
+
+    def rows(self):
+        for row_idx in range(len(self)):
+            yield self.row(row_idx)
+
+    def get(self, row_idx, col_idx):
+        column = self.keys.get(col_idx)
+        if column is not None:
+            return column.get(row_idx)
+
+        cells = self.row(row_idx)
+        if col_idx >= len(cells):
+            return ''
+        return cells[col_idx]
+
+    def distinct_values(self, row_indices, col_indices):
+        """Get the set of distinct values in each of the listed columns,
+        over the specified rows"""
+        result = [set() for col_idx in col_indices]
+        for row_idx in row_indices:
+            # Parse each row once for all of the columns
+            cells = self.row(row_idx)
+            for values, col_idx in zip(result, col_indices):
+                if col_idx < len(cells):
+                    values.add(cells[col_idx])
+                else:
+                    values.add('')
+        return result
+
+    def value_counts(self, row_indices, col_idx):
+        """Get a map of each value in a column to the number of the
+        specified rows with it"""
+        column = self.keys.get(col_idx)
+        if column is not None:
+            return column.value_counts(row_indices)
+
+        result = {}
+        for row_idx in row_indices:
+            value = self.get(row_idx, col_idx)
+            result[value] = result.get(value, 0) + 1
+        return result
+
+    def set(self, row_idx, col_idx, value):
+        cells = list(self.row(row_idx))
+        while col_idx >= len(cells):
+            cells.append('')
+        cells[col_idx] = value
+
+        self.edits[row_idx] = cells
+
+    def set_rows(self, row_indices, col_idx, value):
+        """Set one column of several rows to the same value"""
+        for row_idx in row_indices:
+            self.set(row_idx, col_idx, value)
+
+    def release(self):
+        """Release the file before it is rewritten"""
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+
+    def saved(self, offsets, dirty_rows=()):
+        """Notify the store that its rows have been written to the file,
+        apart from edits to the rows in `dirty_rows`"""
+        self.offsets = offsets
+        self.edits = dict((row_idx, cells)
+                          for row_idx, cells in self.edits.items()
+                          if row_idx in dirty_rows)
+        self._map()
+
+# Local variables:
+# indent-tabs-mode: nil
+# tab-width: 4
+# End:
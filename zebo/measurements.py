@@ -1,266 +1,370 @@
-import csv
-from PyQt4 import QtCore
-
-################################################################
-# Data model
-################################################################
-
-class MeasurementsData(QtCore.QObject):
-
-    dataChanged = QtCore.pyqtSignal()
-
-    def __init__(self, filename, **kwargs):
-        super(MeasurementsData, self).__init__(**kwargs)
-
-        self.filename = filename
-
-        self.col_titles = None
-        self.metadata_cols = None
-        self.measurement_cols = None
-        self.table = None
-        self.path_map = None
-
-        self.dirty = False
-
-    def get_filename(self):
-        return self.filename
-
-    def _load_header(self, row):
-        self.col_titles = row
-        self.metadata_cols = []
-        self.measurement_cols = []
-
-        for idx, title in enumerate(row):
-            title = row[idx]
-
-            name = title.strip()
+import logging
 
-            record = {'idx': idx,
-                      'name': name,
-                      'title': title,
-                      'mutable': False}
-
-            # Metadata column names end with '='
-            if name.endswith('='):
-                record['name'] = name[0:-1]
-                self.metadata_cols.append(record)
-
-            # Measurement column names end with '?'
-            elif name.endswith('?'):
-                record['name'] = name[0:-1]
-                record['mutable'] = True
-                self.measurement_cols.append(record)
-
-            else:
-                self.measurement_cols.append(record)
-
-    def _load(self):
-        # Read in the CSV data
-        with open(self.filename, 'rb') as in_fp:
-            csv_reader = csv.reader(in_fp)
-
-            # The first row should contain column names
-            self._load_header(next(csv_reader))
-
-            # The remaining rows should contain data
-            self.table = list(csv_reader)
-
-        # Build the path map
-        self.path_map = {}
-
-        for row_idx, row in enumerate(self.table):
-            row = self.table[row_idx]
-
-            path = []
-            for record in self.metadata_cols:
-                path.append(row[record['idx']])
-
-            parent = self.path_map
-            for element in path:
-                if not parent.has_key(element):
-                    parent[element] = {}
-                parent = parent[element]
+from PyQt4 import QtCore
 
-            parent['_index_'] = row_idx
+from zebo.dataset import RESIDENT_SHARDS, Dataset
+from zebo.history import HISTORY_LIMIT
+from zebo.journal import SYNC_INTERVAL
+from zebo.model import Measurements
 
-        self.dirty = False
-        print("Loaded from '{}'".format(self.filename))
-        self._emit_data_changed()
+log = logging.getLogger(__name__)
 
-    def _emit_data_changed(self):
-        self.dataChanged.emit()
-
-    def _lazy_load(self):
-        if self.table is None:
-            self._load()
+################################################################
+# Qt data model
+################################################################
 
-    def _save(self):
-        # Write out the CSV data
-        with open(self.filename, 'wb') as out_fp:
-            csv_writer = csv.writer(out_fp)
+class _Worker(QtCore.QThread):
+    """Thread that runs a function, keeping its result or exception"""
 
-            csv_writer.writerow(self.col_titles)
-            csv_writer.writerows(self.table)
+    def __init__(self, func, **kwargs):
+        super(_Worker, self).__init__(**kwargs)
+        self.func = func
+        self.result = None
+        self.error = None
 
-        self.dirty = False
-        print("Saved to '{}'".format(self.filename))
+    def run(self):
+        try:
+            self.result = self.func()
+        except Exception as e:
+            self.error = e
 
-    def _eval_path_map(self, path):
-        self._lazy_load()
+class MeasurementsData(QtCore.QObject, Measurements):
 
-        parent = self.path_map
-        for element in path:
-            if not parent.has_key(element):
-                return None
-            parent = parent[element]
-        return parent
+    # Emitted after any change to the data
+    dataChanged = QtCore.pyqtSignal()
 
-    def metadata_keys(self):
+    # Emitted when the file has been (re)loaded, so the metadata paths
+    # and all of the measurement values may have changed
+    structureChanged = QtCore.pyqtSignal()
+
+    # Emitted with a sorted list of row indices and a list of
+    # measurement keys when measurement values change
+    cellsChanged = QtCore.pyqtSignal(object, object)
+
+    # Emitted with the new value of is_modified() when it changes
+    dirtyChanged = QtCore.pyqtSignal(bool)
+
+    # Emitted with the name of the current stage of a background load
+    # or commit, and the number of steps done out of the total
+    progress = QtCore.pyqtSignal(str, int, int)
+
+    # Emitted when a background load or commit ends, with the exception
+    # that stopped it or None
+    loadFinished = QtCore.pyqtSignal(object)
+    commitFinished = QtCore.pyqtSignal(object)
+
+    def __init__(self, filename, mapped=None, workers=None, cache=None,
+                 history_limit=HISTORY_LIMIT, csv_format=None, journal=False,
+                 **kwargs):
+        # QObject doesn't call the next __init__() in the MRO
+        QtCore.QObject.__init__(self, **kwargs)
+        Measurements.__init__(self, filename, mapped=mapped, workers=workers,
+                              cache=cache, history_limit=history_limit,
+                              csv_format=csv_format, journal=journal)
+
+        # The background load or commit in progress, if any
+        self.worker = None
+
+        # Edits are synced to the journal in batches
+        if journal:
+            self.sync_timer = QtCore.QTimer(self)
+            self.sync_timer.setInterval(int(SYNC_INTERVAL * 1000))
+            self.sync_timer.timeout.connect(self.sync_journal)
+            self.sync_timer.start()
+
+    def is_busy(self):
+        return self.worker is not None
+
+    def _start(self, func, finished):
+        assert self.worker is None
+        self.worker = _Worker(func)
+        self.worker.finished.connect(lambda: self._worker_finished(finished))
+        self.worker.start()
+
+    def _worker_finished(self, finished):
+        worker = self.worker
+        self.worker = None
+        finished(worker.result, worker.error)
+
+    def load_async(self):
+        """(Re)load the file on a worker thread.
+
+        The current contents stay available until loadFinished is
+        emitted, and any edits to them are discarded."""
+        self._start(self._read_file, self._load_finished)
+
+    def _load_finished(self, loaded, error):
+        if error is None:
+            self._install(loaded)
+        self.loadFinished.emit(error)
+
+    def commit_async(self, overwrite=False):
+        """Save changes on worker threads.
+
+        Changes made to the file by something else are worked out, and
+        then the modified rows are written, in the background, with only
+        the results brought into the model on this thread.  Editing can
+        continue meanwhile; later edits stay modified, and a step that
+        was reading the table when it was edited is started again.
+        `overwrite` is as for commit(), and commitFinished is emitted
+        once the file and its cache have been saved."""
         self._lazy_load()
-        return [x["name"] for x in self.metadata_cols]
-
-    def metadata_values(self, path):
-        parent = self._eval_path_map(path)
-        if parent is None:
-            return []
 
-        return parent.keys()
+        count = self.change_count
+        self._start(lambda: self._check_file(overwrite),
+                    lambda result, error: self._file_checked(
+                        result, error, overwrite, count))
 
-    def measurement_keys(self):
-        self._lazy_load()
-        return [x['name'] for x in self.measurement_cols]
-
-    def is_measurement_mutable(self, key):
-        self._lazy_load()
-        for record in self.measurement_cols:
-            if record['name'] == key:
-                return record['mutable']
-        return False
-
-    def _get_row_index(self, path):
-        return self._eval_path_map(path).get('_index_')
-
-    def _get_col_index(self, key):
-        for record in self.measurement_cols:
-            if record['name'] == key:
-                return record['idx']
-        return None
+    def _file_checked(self, result, error, overwrite, count):
+        if self.change_count != count:
+            if result is not None and result[1] is not None:
+                result[1].release()
+            self.commit_async(overwrite)
+            return
 
-    def validate_path(self, path, partial=False):
-        self._lazy_load()
+        if error is None:
+            patch, merge = result
+            try:
+                if merge is not None:
+                    self._apply_merge(merge)
+            except (IOError, OSError) as e:
+                error = e
+        if error is not None:
+            self.commitFinished.emit(error)
+            return
 
-        parent = self._eval_path_map(path)
-        if partial:
-            return parent is not None
+        # A file that still exists is checked again once it's been
+        # written, whether it's patched or written out in full
+        committed = self._begin_commit()
+        check = patch
+        patch = patch and self._should_patch(committed)
+        count = self.change_count
+        self._start(lambda: self._write_committed(committed, patch, count),
+                    lambda result, error: self._commit_finished(
+                        result, error, committed, check, overwrite))
+
+    def _write_committed(self, committed, patch, count):
+        # Runs on the worker thread.  Returns None if the table was
+        # edited while the rows to write were being read from it.
+        if patch:
+            rows = self._snapshot(committed)
         else:
-            return parent.get('_index_') is not None
-
-    def paths_with_prefix(self, prefix=[]):
-        parent = self._eval_path_map(prefix)
-
-        if parent.get('_index_') is not None:
-            yield prefix
+            written = self._write_file()
+        if self.change_count != count:
+            if not patch:
+                self._discard_changes(written)
+            return None
+        if patch:
+            written = self._write_changes(rows)
+        return written
+
+    def _commit_finished(self, result, error, committed, check, overwrite):
+        if error is None and result is None:
+            self._abort_commit(committed)
+            self.commit_async(overwrite)
             return
 
-        for k in parent.keys():
-            for p in self.paths_with_prefix(prefix + [k]):
-                yield p
+        # The new file only holds the changes merged from the old one, so
+        # it's only valid if nothing else changed that in the meantime
+        if (error is None and check
+            and not self._can_save_changes(committed)):
+            self._discard_changes(result)
+            error = IOError("'{}' was changed while it was being saved"
+                            .format(self.filename))
+
+        if error is None:
+            try:
+                self._finish_commit(result, committed)
+            except (IOError, OSError) as e:
+                error = e
+        else:
+            self._abort_commit(committed)
 
-    def get_measurement(self, path, key):
-        self._lazy_load()
-        row_idx = self._get_row_index(path)
-        col_idx = self._get_col_index(key)
+        jobs = []
+        if error is None:
+            jobs = self._cache_jobs(result)
+        if not jobs:
+            self.commitFinished.emit(error)
+            return
 
-        assert row_idx is not None
-        assert col_idx is not None
-        assert len(self.table) > row_idx
+        count = self.change_count
+        self._start(lambda: self._stage_caches(jobs),
+                    lambda staged, error: self._caches_staged(
+                        staged, error, count))
+
+    def _caches_staged(self, staged, error, count):
+        # The caches are only valid if nothing was edited while they were
+        # being written.  They're only an optimisation, so failing to
+        # write them doesn't fail the commit.
+        if error is not None:
+            log.warning("Couldn't write the cache of '%s': %s",
+                        self.filename, error)
+        else:
+            self._install_caches(staged, self.change_count == count)
+        self.commitFinished.emit(None)
 
-        if col_idx >= len(self.table[row_idx]):
-            return ''
+    def _emit_data_changed(self):
+        self.dataChanged.emit()
 
-        return self.table[row_idx][col_idx]
+    def _emit_structure_changed(self):
+        self.structureChanged.emit()
 
-    def set_measurement(self, path, key, value, partial=False):
+    def _emit_cells_changed(self, rows, keys):
+        self.cellsChanged.emit(rows, keys)
 
-        self._lazy_load()
+    def _emit_dirty_changed(self, dirty):
+        self.dirtyChanged.emit(dirty)
 
-        def row_indices(pmap=None, path=None):
+    def _emit_progress(self, stage, done, total):
+        self.progress.emit(stage, done, total)
 
-            assert path is not None
+class DatasetData(MeasurementsData, Dataset):
+    """Qt data model for a dataset of several CSV files"""
 
-            if pmap is None:
-                pmap = self._eval_path_map(path)
-                if not partial:
-                    assert pmap.get('_index_') is not None
+    def __init__(self, filenames, mapped=None, workers=None, cache=None,
+                 resident=RESIDENT_SHARDS, history_limit=HISTORY_LIMIT,
+                 csv_format=None, **kwargs):
+        QtCore.QObject.__init__(self, **kwargs)
+        Dataset.__init__(self, filenames, mapped=mapped, workers=workers,
+                         cache=cache, resident=resident,
+                         history_limit=history_limit, csv_format=csv_format)
+        self.worker = None
 
-            if pmap.has_key('_index_'):
-                yield (path, pmap['_index_'])
-            else:
-                for k in pmap.iterkeys():
-                    sub_path = path + [k]
-                    for pair in row_indices(pmap=pmap[k], path=sub_path):
-                        yield pair
+################################################################
+# Qt table model
+################################################################
 
-        col_idx = self._get_col_index(key)
+class MeasurementsTableModel(QtCore.QAbstractTableModel):
+    """Table of the rows of a MeasurementsData with a path prefix.
 
-        for row_path, row_idx in row_indices(path=path):
+    Rows are added to the table in blocks as the view scrolls to them,
+    and values are only read from the data model when they are
+    displayed, so large tables stay responsive."""
 
-            print("{} - {} - {}".format(row_path, key, value))
+    # Number of rows added to the table at a time
+    FETCH_SIZE = 256
 
-            assert row_idx is not None
-            assert col_idx is not None
-            assert len(self.table) > row_idx
+    def __init__(self, model, **kwargs):
+        super(MeasurementsTableModel, self).__init__(**kwargs)
 
-            while col_idx >= len(self.table[row_idx]):
-                self.table[row_idx].append('')
+        self.model = model
+        self.prefix = []
 
-            self.table[row_idx][col_idx] = value
+        # The values of the most recently displayed row
+        self.cached_row = None
+        self.cached_values = None
 
-        self.dirty = True
-        self._emit_data_changed()
+        # Table rows of the data model in path order, of which the
+        # first `fetched` are in the table
+        self.rows = []
+        self.fetched = 0
 
-    def commit(self):
-        self._save()
-        self._load()
+        self._update_keys()
+        self._update_rows()
 
-    def revert(self):
-        self._load()
+        self.model.cellsChanged.connect(self._cells_changed)
+        self.model.structureChanged.connect(self._structure_changed)
 
-    def is_modified(self):
-        return self.dirty
+    def _update_keys(self):
+        self.metadata_keys = self.model.metadata_keys()
+        self.keys = self.metadata_keys + self.model.measurement_keys()
 
-    def _path_at_row(self, row_idx):
-        """Get the path corresponding to the specified row of the data table"""
-        row = self.table[row_idx]
+    def setPrefix(self, prefix):
+        self.beginResetModel()
+        self.prefix = list(prefix)
+        self._update_rows()
+        self.endResetModel()
 
-        path = []
-        for record in self.metadata_cols:
-            path.append(row[record['idx']])
-        return path
+    def _update_rows(self):
+        self.rows = self.model.rows_with_prefix(self.prefix)
+        self.fetched = min(len(self.rows), self.FETCH_SIZE)
+        self.cached_row = None
 
-    def path_next(self, path):
-        row_idx = self._get_row_index(path)
+    def _values(self, row):
+        row_idx = self.rows[row]
+        if row_idx != self.cached_row:
+            self.cached_values = self.model.get_row_values(row_idx)
+            self.cached_row = row_idx
+        return self.cached_values
 
-        if row_idx is None:
-            return None
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return self.fetched
 
-        row_idx += 1 # Next row
-        if row_idx >= len(self.table):
-            return None
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.keys)
 
-        return self._path_at_row(row_idx)
+    def canFetchMore(self, parent):
+        if parent.isValid():
+            return False
+        return self.fetched < len(self.rows)
 
-    def path_previous(self, path):
-        row_idx = self._get_row_index(path)
+    def fetchMore(self, parent):
+        if parent.isValid():
+            return
+        count = min(len(self.rows) - self.fetched, self.FETCH_SIZE)
+        self.beginInsertRows(parent, self.fetched, self.fetched + count - 1)
+        self.fetched += count
+        self.endInsertRows()
 
-        if row_idx is None:
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
             return None
+        if role in (QtCore.Qt.DisplayRole, QtCore.Qt.EditRole):
+            return self._values(index.row())[index.column()]
+        return None
 
-        row_idx -= 1 # Previous row
-        if row_idx < 0:
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if role != QtCore.Qt.DisplayRole:
             return None
-
-        return self._path_at_row(row_idx)
+        if orientation == QtCore.Qt.Horizontal:
+            return self.keys[section].replace("_", " ")
+        return section + 1
+
+    def _is_mutable(self, column):
+        return (column >= len(self.metadata_keys)
+                and self.model.is_measurement_mutable(self.keys[column]))
+
+    def flags(self, index):
+        flags = super(MeasurementsTableModel, self).flags(index)
+        if index.isValid() and self._is_mutable(index.column()):
+            flags |= QtCore.Qt.ItemIsEditable
+        return flags
+
+    def setData(self, index, value, role=QtCore.Qt.EditRole):
+        if role != QtCore.Qt.EditRole or not self._is_mutable(index.column()):
+            return False
+        # With the old PyQt4 API, values are wrapped in a QVariant
+        if isinstance(value, QtCore.QVariant):
+            value = value.toString()
+        try:
+            self.model.set_row_measurement(self.rows[index.row()],
+                                           self.keys[index.column()],
+                                           str(value))
+        except ValueError:
+            # Not a valid value for the column's declared type
+            return False
+        return True
+
+    def _cells_changed(self, rows, keys):
+        # Only the visible cells are repainted, so it's cheaper to
+        # refresh whole columns than to find the changed rows
+        self.cached_row = None
+        if self.fetched == 0:
+            return
+        for column, key in enumerate(self.keys):
+            if column >= len(self.metadata_keys) and key in keys:
+                self.dataChanged.emit(self.index(0, column),
+                                      self.index(self.fetched - 1, column))
+
+    def _structure_changed(self):
+        self.beginResetModel()
+        self._update_keys()
+        self._update_rows()
+        self.endResetModel()
 
 # Local variables:
 # indent-tabs-mode: nil
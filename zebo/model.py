@@ -0,0 +1,1429 @@
+import contextlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+from array import array
+from collections import OrderedDict
+
+from zebo import cache, csvio, instrument, parallel
+from zebo.history import HISTORY_LIMIT, EditHistory, make_delta
+from zebo.columns import ColumnDiffer, ColumnStore, TypedColumn
+from zebo.index import PathIndex
+from zebo.journal import Journal, Recovery
+from zebo.mapped import MappedStore
+from zebo.schema import NUMBER, Schema
+from zebo.stats import summarize
+
+# Files at least this large are memory-mapped and parsed on demand
+# rather than loaded into memory, unless specified otherwise
+MAPPED_SIZE_THRESHOLD = 64 << 20
+
+# Files at least this large have their parsed contents cached in a
+# binary file alongside them, unless specified otherwise
+CACHE_SIZE_THRESHOLD = 8 << 20
+
+# Number of times a file is read before giving up, if it keeps being
+# changed while it's being read
+READ_ATTEMPTS = 3
+
+# Commits write the whole table out rather than patching the modified
+# rows into a copy of the file once at least this fraction of the rows
+# are modified, as that's then quicker, as long as there are enough of
+# them to make a difference
+REWRITE_FRACTION = 0.3
+REWRITE_MIN_ROWS = 10000
+
+# Number of path prefixes for which measurement summaries, and
+# separately statistics, are kept
+SUMMARY_CACHE_SIZE = 256
+
+log = logging.getLogger(__name__)
+
+################################################################
+# Data model
+################################################################
+
+_NUMBER_RE = re.compile(r'^\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?\s*$')
+_DIGITS_RE = re.compile(r'(\d+)')
+
+def natural_key(value):
+    """Sort key that orders numbers by value, and runs of digits within
+    other strings by their numeric value, e.g. 'x2' before 'x10'"""
+    if _NUMBER_RE.match(value):
+        return (0, float(value), [], value)
+
+    # Splitting on runs of digits gives alternating strings and
+    # digits, so the parts always compare against the same type
+    parts = _DIGITS_RE.split(value)
+    for idx in range(1, len(parts), 2):
+        parts[idx] = int(parts[idx])
+    return (1, 0, parts, value)
+
+class LoadedFile(object):
+    """Contents of a CSV file read by read_table()"""
+
+    def __init__(self, col_titles, table, index, file_version,
+                 csv_format=csvio.DEFAULT_FORMAT):
+        self.col_titles = col_titles
+        self.schema = Schema(col_titles)
+        self.table = table
+        self.index = index
+
+        # Size, modification time and fingerprint of the file when it
+        # was read
+        self.file_version = file_version
+
+        # Encoding and dialect of the file
+        self.csv_format = csv_format
+
+class MergeConflict(IOError):
+    """Raised when cells with unsaved edits have also been changed in
+    the file by something else.
+
+    `conflicts` lists (path, key, ours, theirs) tuples, where `theirs`
+    is None if the row has been removed from the file."""
+
+    def __init__(self, filename, conflicts):
+        IOError.__init__(self, "{} edited cells of '{}' have also been "
+                         "changed by something else"
+                         .format(len(conflicts), filename))
+        self.conflicts = conflicts
+
+class DirtyCells(object):
+    """Set of modified cells, with the value of each cell in the file.
+
+    Cells are kept column by column, as edits set one column of any
+    number of rows, so that an edit to every row of a large file doesn't
+    need a map for each row.  Iterating gives the modified rows."""
+
+    def __init__(self):
+        # Map of column index to a map of row index to file value
+        self.columns = {}
+
+    def __len__(self):
+        return len(self.rows())
+
+    def __bool__(self):
+        return any(self.columns.values())
+    __nonzero__ = __bool__
+
+    def __iter__(self):
+        return iter(self.rows())
+
+    def __contains__(self, row_idx):
+        return any(row_idx in rows for rows in self.columns.values())
+
+    def rows(self):
+        """Get the set of modified rows"""
+        return set().union(*self.columns.values())
+
+    def col_indices(self):
+        """Get the set of modified columns"""
+        return set(col_idx for col_idx, rows in self.columns.items()
+                   if rows)
+
+    def cells(self):
+        """Iterate over (row index, column index, file value) for every
+        modified cell"""
+        for col_idx, rows in self.columns.items():
+            for row_idx, base in rows.items():
+                yield row_idx, col_idx, base
+
+    def column(self, col_idx):
+        """Get the map of row index to file value of the modified cells
+        in a column, which may be changed"""
+        rows = self.columns.get(col_idx)
+        if rows is None:
+            rows = self.columns[col_idx] = {}
+        return rows
+
+    def add(self, row_idx, col_idx, base):
+        self.column(col_idx)[row_idx] = base
+
+    def update(self, other):
+        """Add the cells of another DirtyCells, taking their file values"""
+        for col_idx, rows in other.columns.items():
+            self.column(col_idx).update(rows)
+
+    def subset(self, row_indices):
+        """Get the cells in the listed rows as a new DirtyCells"""
+        row_indices = set(row_indices)
+        subset = DirtyCells()
+        for col_idx, rows in self.columns.items():
+            subset.columns[col_idx] = dict(
+                (row_idx, base) for row_idx, base in rows.items()
+                if row_idx in row_indices)
+        return subset
+
+class _Merge(object):
+    """Changes made to a file by something else, worked out by
+    Measurements._prepare_merge() without changing the model"""
+
+    def __init__(self, version, loaded, offsets, updates, moved, ours,
+                 dirty_cells, changed, conflicts):
+        # Version of the file that the changes were found in
+        self.version = version
+
+        # LoadedFile to replace the table with if rows have moved, or
+        # else the file's row offsets and a list of (row index, column
+        # index, value) for the cells to update in place
+        self.loaded = loaded
+        self.offsets = offsets
+        self.updates = updates
+
+        # Map of old to new row index for the rows with edits, and map
+        # of (old row index, column index) to the value of each edit
+        self.moved = moved
+        self.ours = ours
+
+        # The dirty cells once the changes are in
+        self.dirty_cells = dirty_cells
+
+        # List of (row index, measurement key) for the cells to notify
+        # as changed, or None if the whole structure may have changed
+        self.changed = changed
+
+        # Number of edits that overwrite a change in the file
+        self.conflicts = conflicts
+
+    def release(self):
+        """Release the file if the merge won't be applied"""
+        if self.loaded is not None:
+            self.loaded.table.release()
+
+def _use_mapped(filename, mapped):
+    if mapped is None:
+        return os.path.getsize(filename) >= MAPPED_SIZE_THRESHOLD
+    return mapped
+
+def cache_enabled(filename, use_cache=None, mapped=None):
+    """Whether the parsed contents of a file are cached alongside it,
+    given the `cache` and `mapped` options of Measurements"""
+    # The mapped backend relies on the cache to avoid scanning the
+    # whole file for its row offsets
+    if use_cache is None:
+        return (_use_mapped(filename, mapped)
+                or os.path.getsize(filename) >= CACHE_SIZE_THRESHOLD)
+    return use_cache
+
+def _no_progress(stage, done, total):
+    pass
+
+def read_table(filename, mapped=None, use_cache=None, workers=None,
+               progress=_no_progress, csv_format=None):
+    """Read and index a CSV file.
+
+    `mapped`, `use_cache`, `workers` and `csv_format` are as for
+    Measurements, and `progress` is called with the name of each stage
+    of loading and the number of stages done out of the total.  This
+    doesn't touch any model, so it may be called on a worker thread.
+
+    If the file is changed by something else while it's being read, it
+    is read again, up to READ_ATTEMPTS times.  Returns a LoadedFile."""
+    for attempt in range(READ_ATTEMPTS):
+        try:
+            loaded = _read_table(filename, mapped, use_cache, workers,
+                                 progress, csv_format)
+        except parallel.FileChanged:
+            log.info("'%s' was replaced while being read", filename)
+            continue
+
+        # The version is taken before reading, so if it still matches
+        # the file then the table holds exactly that version
+        if cache.file_version(filename) == loaded.file_version:
+            return loaded
+        log.info("'%s' was changed while being read", filename)
+        loaded.table.release()
+
+    raise IOError("'{}' kept changing while it was being read"
+                  .format(filename))
+
+def _read_table(filename, mapped, use_cache, workers, progress, csv_format):
+    progress('Reading', 0, 3)
+
+    # The version is taken from the file being parsed, before any of it
+    # is read, and every worker reads that same file
+    with open(filename, 'rb') as in_fp:
+        file_version = cache.fp_version(in_fp)
+
+        # The first row should contain column names
+        offsets = array('l')
+        if csv_format is None:
+            csv_format = csvio.sniff_format(in_fp)
+        else:
+            in_fp.seek(len(csv_format.bom))
+        col_titles = next(csvio.read_rows(in_fp, offsets, csv_format))
+        schema = Schema(col_titles)
+        key_cols = schema.key_cols
+
+        # The mapped backend only needs the metadata columns to be
+        # loaded up front
+        use_cache = cache_enabled(filename, use_cache, mapped)
+        mapped = _use_mapped(filename, mapped)
+        if mapped:
+            col_indices = key_cols
+        else:
+            col_indices = None
+
+        cached = None
+        if use_cache:
+            cached = cache.read_cache(filename, file_version, col_indices,
+                                      key_cols)
+
+        index = None
+        if cached is not None:
+            offsets = cached.offsets
+            columns = cached.columns
+            index = cached.index
+        else:
+            # The remaining rows should contain data
+            workers = parallel.worker_count(filename, workers)
+            column_list, nrows = parallel.read_columns(
+                in_fp, offsets, workers, col_indices, csv_format)
+
+            if col_indices is None:
+                col_indices = range(len(column_list))
+            columns = dict(zip(col_indices, column_list))
+
+    # Typed columns have their distinct values parsed once, here
+    for info in schema.columns:
+        if info.type is not None and info.idx in columns:
+            columns[info.idx] = TypedColumn.from_column(columns[info.idx],
+                                                        info.type)
+
+    if mapped:
+        table = MappedStore(filename, offsets, columns, csv_format)
+    else:
+        table = ColumnStore.from_columns(
+            [columns[col_idx] for col_idx in sorted(columns)],
+            len(offsets) - 1, len(col_titles))
+        table.offsets = offsets
+
+    if index is None:
+        progress('Indexing', 1, 3)
+        index = PathIndex([table.column(col_idx) for col_idx in key_cols],
+                          len(table))
+        if use_cache:
+            progress('Caching', 2, 3)
+            write_table_cache(filename, file_version, table, index,
+                              key_cols)
+
+    progress('Loaded', 3, 3)
+    return LoadedFile(col_titles, table, index, file_version, csv_format)
+
+def write_table_cache(filename, file_version, table, index, key_cols):
+    cache.install_cache(filename, stage_table_cache(filename, file_version,
+                                                    table, index, key_cols))
+
+def stage_table_cache(filename, file_version, table, index, key_cols):
+    """Write the cache of a table to a new file, as for
+    cache.stage_cache()"""
+    if isinstance(table, ColumnStore):
+        columns = dict(enumerate(table.columns))
+        complete = True
+    else:
+        columns = dict((col_idx, table.column(col_idx))
+                       for col_idx in key_cols)
+        complete = False
+
+    return cache.stage_cache(filename, file_version, table.offsets, columns,
+                             complete, index, key_cols)
+
+def write_patched(filename, offsets, rows, csv_format=csvio.DEFAULT_FORMAT):
+    """Write a copy of a CSV file with some rows replaced, alongside it.
+
+    `offsets`, `rows` and `csv_format` are as for csvio.copy_patched().
+    The copy is synced to disk, so it can safely be renamed over the
+    original.
+    Returns the name of the copy and its row offsets."""
+    fd, temp_filename = _temp_file(filename)
+
+    try:
+        with os.fdopen(fd, 'wb') as out_fp:
+            with open(filename, 'rb') as in_fp:
+                offsets = csvio.copy_patched(in_fp, out_fp, offsets, rows,
+                                             csv_format)
+            csvio.sync_file(out_fp)
+
+        shutil.copymode(filename, temp_filename)
+    except:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
+
+    return temp_filename, offsets
+
+def _temp_file(filename):
+    directory = os.path.dirname(os.path.abspath(filename))
+    return tempfile.mkstemp(dir=directory, suffix='.tmp')
+
+class Measurements(object):
+    """Measurements data model, independent of any user interface.
+
+    Subclasses can override the _emit_*() methods to be notified of
+    changes to the data."""
+
+    def __init__(self, filename, mapped=None, workers=None, cache=None,
+                 history_limit=HISTORY_LIMIT, csv_format=None, journal=False):
+        self.filename = filename
+        self.mapped = mapped
+        self.workers = workers
+        self.cache = cache
+
+        # Whether edits are logged to a journal alongside the file as
+        # they're made, so that they can be recovered after a crash
+        self.use_journal = journal
+        self.journal = None
+
+        # Edits found in the journals of finished sessions when the file
+        # was first loaded, as for read_journal(), until they're
+        # recovered or discarded
+        self.recoverable = []
+
+        # CSVFormat to read and write the file with, or None to guess it
+        # from the file each time it's loaded
+        self.format_override = csv_format
+        self.csv_format = csv_format
+
+        self.col_titles = None
+        self.schema = None
+        self.table = None
+        self.index = None
+
+        # Size, modification time and fingerprint of the file when it
+        # was last loaded, saved or merged
+        self.file_version = None
+
+        # Modified cells with the value of each in the file, which is
+        # what other changes to the file are compared against when
+        # merging them
+        self.dirty_cells = DirtyCells()
+
+        self.dirty = False
+
+        # Maps of path prefix tuple to a map of measurement key to the
+        # sorted distinct values, or the Statistics, under that prefix,
+        # most recently used last
+        self._clear_summaries()
+
+        # Map of path prefix tuple to the sorted metadata values below
+        # it.  Only structural changes can invalidate this.
+        self.values_cache = {}
+
+        # Number of times cells have been changed by editing, undoing or
+        # redoing, so that work done on a worker thread can tell whether
+        # the table changed while it was reading it
+        self.change_count = 0
+
+        # Edits that can be undone and redone.  A batch of edits is
+        # undone as one step.
+        self.history = EditHistory(history_limit)
+
+        # Changes not yet notified because a batch of edits is open
+        self.batch_depth = 0
+        self.pending_rows = set()
+        self.pending_keys = set()
+
+    def get_filename(self):
+        return self.filename
+
+    def _use_cache(self):
+        return cache_enabled(self.filename, self.cache, self.mapped)
+
+    def _key_cols(self):
+        return self.schema.key_cols
+
+    def _read_file(self):
+        """Read and index the CSV file, without changing the model.
+
+        This may be called on a worker thread.  Returns a LoadedFile to
+        pass to _install()."""
+        return read_table(self.filename, self.mapped, self.cache,
+                          self.workers, self._emit_progress,
+                          self.format_override)
+
+    def _replace_table(self, loaded):
+        # Swap in a file read by _read_file(), without any edits to it
+        if self.table is not None:
+            self.table.release()
+
+        self.col_titles = loaded.col_titles
+        self.schema = loaded.schema
+        self.table = loaded.table
+        self.index = loaded.index
+        self.file_version = loaded.file_version
+        self.csv_format = loaded.csv_format
+
+        self.dirty_cells = DirtyCells()
+        self._clear_summaries()
+        self.values_cache = {}
+
+    def _install(self, loaded):
+        """Replace the contents of the model with a file read by
+        _read_file()"""
+        self._replace_table(loaded)
+        self.history.clear()
+        log.info("Loaded from '%s'", self.filename)
+
+        self._open_journal()
+
+        self._emit_structure_changed()
+        self._set_dirty(False)
+        self._emit_data_changed()
+
+    def _load(self):
+        self._install(self._read_file())
+
+    def _open_journal(self):
+        # Only the first load recovers edits from the journals of other
+        # sessions; reloading the file discards any edits
+        if not self.use_journal:
+            return
+
+        if self.journal is not None:
+            self.recoverable = []
+            self._start_journal([])
+            return
+
+        recovery = Recovery(self.filename, self.file_version)
+        self.recoverable = recovery.edits
+        if self.recoverable:
+            log.warning("'%s' has %d unsaved edits from a previous session",
+                        self.filename, len(self.recoverable))
+
+        # This session's journal starts with the recoverable edits, so
+        # they're replayed in order if it crashes too.  Only then can
+        # the journals they came from be removed.
+        self._start_journal(self.recoverable)
+        recovery.release(remove=self.journal is not None)
+
+    def _start_journal(self, edits):
+        # Editing is still possible without a journal, e.g. in a
+        # read-only directory
+        try:
+            if self.journal is None:
+                self.journal = Journal(self.filename, self.file_version,
+                                       edits)
+            else:
+                self.journal.restart(self.file_version, edits)
+        except (IOError, OSError):
+            log.exception("Couldn't write the journal of '%s'", self.filename)
+            self._drop_journal()
+
+    def _drop_journal(self):
+        # Stop logging edits after the journal has failed
+        if self.journal is not None:
+            try:
+                self.journal.close(remove=True)
+            except (IOError, OSError):
+                pass
+            self.journal = None
+
+    def _rewrite_journal(self):
+        # Start the journal again from the current edits, e.g. when the
+        # file has been saved
+        if self.journal is None:
+            return
+
+        edits = {}
+        for row_idx, col_idx, base in sorted(self.dirty_cells.cells()):
+            value = self.table.get(row_idx, col_idx)
+            edits.setdefault((col_idx, value), []).append(row_idx)
+
+        self._start_journal([(col_idx, value, rows) for (col_idx, value), rows
+                             in sorted(edits.items())])
+
+    def recover(self):
+        """Make the edits found in the journal when the file was loaded
+        again, as one step that can be undone"""
+        edits = self.recoverable
+        self.recoverable = []
+
+        names = dict((info.idx, info.name)
+                     for info in self.schema.measurements if info.mutable)
+        with self.batch():
+            for col_idx, value, row_indices in edits:
+                if not row_indices:
+                    continue
+                if col_idx not in names or max(row_indices) >= len(self.table):
+                    log.warning("Skipped a journal edit that doesn't match "
+                                "'%s'", self.filename)
+                    continue
+                self._set_rows([], row_indices, names[col_idx], col_idx,
+                               value)
+        log.info("Recovered %d edits to '%s'", len(edits), self.filename)
+
+        self._rewrite_journal()
+
+    def discard_recovery(self):
+        """Forget the edits found in the journal when the file was
+        loaded"""
+        self.recoverable = []
+        self._rewrite_journal()
+
+    def sync_journal(self):
+        """Make sure that every edit logged to the journal is on disk"""
+        if self.journal is not None:
+            self.journal.sync()
+
+    def close_journal(self):
+        """Stop logging edits, and remove the journal.  Call this when
+        the model is finished with and any edits have been saved or are
+        to be discarded."""
+        if self.journal is not None:
+            self.journal.close(remove=True)
+            self.journal = None
+
+    def _emit_data_changed(self):
+        # Called after any change to the data
+        pass
+
+    def _emit_structure_changed(self):
+        # Called when the file has been (re)loaded, so the metadata paths
+        # and all of the measurement values may have changed
+        pass
+
+    def _emit_cells_changed(self, rows, keys):
+        # Called with a sorted list of row indices and a list of
+        # measurement keys when measurement values change
+        pass
+
+    def _emit_dirty_changed(self, dirty):
+        # Called with the new value of is_modified() when it changes
+        pass
+
+    def _emit_progress(self, stage, done, total):
+        # Called, possibly from a worker thread, with the name of the
+        # current stage of a load or commit and how far through it is
+        pass
+
+    def _set_dirty(self, dirty):
+        if dirty == self.dirty:
+            return
+        self.dirty = dirty
+        self._emit_dirty_changed(dirty)
+
+    def _lazy_load(self):
+        if self.table is None:
+            self._load()
+
+    def _file_version(self):
+        return cache.file_version(self.filename)
+
+    def _write_file(self):
+        # Write out all of the CSV data to a new file
+        fd, temp_filename = _temp_file(self.filename)
+
+        offsets = array('l')
+        try:
+            with os.fdopen(fd, 'wb') as out_fp:
+                out_fp.write(self.csv_format.bom)
+                csvio.write_rows(out_fp, [self.col_titles], offsets,
+                                 self.csv_format)
+                csvio.write_rows(out_fp, self.table.rows(), offsets,
+                                 self.csv_format)
+                csvio.sync_file(out_fp)
+
+            if os.path.exists(self.filename):
+                shutil.copymode(self.filename, temp_filename)
+        except:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            raise
+
+        return temp_filename, offsets
+
+    def _begin_commit(self):
+        """Take the dirty cells to be committed, so that editing can
+        continue while they're written.
+
+        Returns the dirty cells, to pass to _snapshot().  Edits made
+        after this are tracked separately, and stay modified."""
+        committed = self.dirty_cells
+        self.dirty_cells = DirtyCells()
+        return committed
+
+    def _should_patch(self, committed):
+        """Whether to write the committed cells by patching the modified
+        rows into a copy of the file, rather than writing the table out
+        with _write_file(), which is quicker once most rows are
+        modified"""
+        nrows = len(committed)
+        return (nrows < REWRITE_MIN_ROWS
+                or nrows < REWRITE_FRACTION * len(self.table))
+
+    def _snapshot(self, committed):
+        """Get the rows with the committed cells, to pass to
+        _write_changes().  This only reads the table, so it may be
+        called on a worker thread, but edits made meanwhile (see
+        change_count) may or may not be included."""
+        return dict((row_idx, self.table.row(row_idx))
+                    for row_idx in committed)
+
+    def _write_changes(self, rows):
+        """Write a copy of the CSV file with the specified rows replaced.
+
+        Only reads the file and `rows`, so this may be called on a worker
+        thread.  Returns the name of the new file and its row offsets,
+        to pass to _finish_commit() or _discard_changes()."""
+        self._emit_progress('Writing', 0, 1)
+        written = write_patched(self.filename, self.table.offsets, rows,
+                                self.csv_format)
+        self._emit_progress('Saved', 1, 1)
+        return written
+
+    def _discard_changes(self, written):
+        temp_filename, offsets = written
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+
+    def _abort_commit(self, committed):
+        # The committed cells still need to be saved, and the file
+        # still holds the values they had before the commit
+        self.dirty_cells.update(committed)
+
+    def _finish_commit(self, written, committed):
+        """Move a file written by _write_file() or _write_changes() into
+        place.  `committed` holds the dirty cells that it saves."""
+        temp_filename, offsets = written
+
+        # The file is replaced by renaming the new one over it, so it's
+        # never left half written.  Its version is taken first, so that
+        # it's the version of the file that was written.
+        self.table.release()
+        try:
+            version = cache.file_version(temp_filename)
+            csvio.replace_file(temp_filename, self.filename)
+        except:
+            self._discard_changes(written)
+            self._abort_commit(committed)
+            self.table.saved(self.table.offsets, self.dirty_cells)
+            raise
+
+        self.table.saved(offsets, self.dirty_cells)
+        self.file_version = version
+        log.info("Saved %d rows to '%s'", len(committed), self.filename)
+
+        # The journal only needs the edits made since the commit began
+        self._rewrite_journal()
+
+        self._committed()
+
+    def _cache_jobs(self, written):
+        """List the caches to update after a commit has been finished,
+        as (filename, file version, table, index) tuples, where the
+        index is None if it must be built for the table"""
+        # The cache must match the file, so it can't hold any edits
+        # made since the commit began
+        if not self._use_cache() or self.dirty_cells:
+            return []
+        return [(self.filename, self.file_version, self.table, self.index)]
+
+    def _stage_caches(self, jobs):
+        """Write the caches listed by _cache_jobs() to new files, as for
+        cache.stage_cache().  This only reads the tables, so it may be
+        called on a worker thread.
+
+        Returns a list of (filename, staged file name) pairs."""
+        key_cols = self._key_cols()
+        staged = []
+        try:
+            for filename, file_version, table, index in jobs:
+                if index is None:
+                    index = PathIndex([table.column(col_idx)
+                                       for col_idx in key_cols], len(table))
+                temp_filename = stage_table_cache(filename, file_version,
+                                                  table, index, key_cols)
+                if temp_filename is not None:
+                    staged.append((filename, temp_filename))
+        except:
+            self._install_caches(staged, False)
+            raise
+        return staged
+
+    def _install_caches(self, staged, valid=True):
+        # Move the caches written by _stage_caches() into place, or
+        # throw them away if they're no longer valid
+        for filename, temp_filename in staged:
+            if valid:
+                cache.install_cache(filename, temp_filename)
+            else:
+                cache.discard_cache(temp_filename)
+
+    def _write_caches(self, written):
+        self._install_caches(self._stage_caches(self._cache_jobs(written)))
+
+    def _committed(self):
+        # The table and index are still valid, so there is no need to
+        # reload the file
+        self._set_dirty(bool(self.dirty_cells))
+        self._emit_data_changed()
+
+    def _can_save_changes(self, committed=None):
+        # Only the modified rows need to be written if the file hasn't
+        # been changed since it was loaded or saved.  `committed` holds
+        # any dirty cells taken by _begin_commit() that are being saved.
+        try:
+            return self._file_version() == self.file_version
+        except (IOError, OSError):
+            return False
+
+    def _merge_if_changed(self, overwrite=False):
+        """Merge in any changes made to the file by something else since
+        it was loaded or saved, as for _merge_changes().
+
+        Returns False if the file no longer exists, so it must be
+        written in full."""
+        patch, merge = self._check_file(overwrite)
+        if merge is not None:
+            self._apply_merge(merge)
+        return patch
+
+    def _check_file(self, overwrite=False):
+        """Work out what _merge_if_changed() needs to do without changing
+        the model, so that this may be called on a worker thread.
+
+        Returns whether only the modified rows need to be written, and
+        the _Merge to pass to _apply_merge(), or None if there's nothing
+        to merge."""
+        if self._can_save_changes():
+            return True, None
+        if not os.path.exists(self.filename):
+            return False, None
+        return True, self._prepare_merge(overwrite)
+
+    def _merge_changes(self, overwrite=False):
+        """Bring changes made to the file by something else into the
+        model, keeping the unsaved edits.
+
+        The file is compared with the table column by column, and only
+        the cells that differ are updated.  If rows have been added,
+        removed or reordered, the file is reloaded instead and the rows
+        that have been edited, or that can be undone or redone, are
+        matched up with it by path.  If an edited cell has also been
+        changed to a different value, MergeConflict is raised without
+        changing anything, unless `overwrite` is set to keep the edit.
+        Either way the edit history and the journal carry on."""
+        self._apply_merge(self._prepare_merge(overwrite))
+
+    def _prepare_merge(self, overwrite=False):
+        """Work out the changes for _merge_changes() without changing the
+        model, and return them as a _Merge for _apply_merge().  This
+        only reads the table, so it may be called on a worker thread,
+        as long as the result is discarded if the table has been edited
+        in the meantime (see change_count)."""
+        version = self._file_version()
+
+        loaded = None
+        offsets = None
+        updates = []
+        scanned = self._scan_changes()
+        if scanned is not None:
+            offsets, updates, theirs = scanned
+            moved = dict((row_idx, row_idx) for row_idx in self.dirty_cells)
+        else:
+            loaded = read_table(self.filename, self.mapped, self.cache,
+                                self.workers, self._emit_progress,
+                                self.csv_format)
+            try:
+                moved, theirs = self._match_rows(loaded)
+            except:
+                loaded.table.release()
+                raise
+
+        names = dict((info.idx, info.name)
+                     for info in self.schema.measurements)
+        ours = {}
+        conflicts = []
+        for row_idx, col_idx, base in sorted(self.dirty_cells.cells()):
+            value = self.table.get(row_idx, col_idx)
+            other = theirs.get((row_idx, col_idx))
+            if other != base and other != value:
+                conflicts.append((self.path_at_row(row_idx),
+                                  names[col_idx], value, other))
+            ours[(row_idx, col_idx)] = value
+
+        # The comparison is only valid if the file hasn't changed again
+        # while it was being read
+        if self._file_version() != version:
+            error = IOError("'{}' was changed while it was being merged"
+                            .format(self.filename))
+        elif conflicts and not overwrite:
+            error = MergeConflict(self.filename, conflicts)
+        else:
+            error = None
+        if error is not None:
+            if loaded is not None:
+                loaded.table.release()
+            raise error
+
+        # The edits become relative to the file as it is
+        dirty_cells = DirtyCells()
+        for (row_idx, col_idx), value in ours.items():
+            new_idx = moved.get(row_idx)
+            if new_idx is not None:
+                dirty_cells.add(new_idx, col_idx, theirs[(row_idx, col_idx)])
+
+        if loaded is not None or not isinstance(self.table, ColumnStore):
+            # Rows may have moved, and the mapped backend doesn't know
+            # which rows have changed
+            changed = None
+        else:
+            # Cells outside the measurement columns, e.g. beyond the end
+            # of the header, aren't shown
+            changed = [(row_idx, names[col_idx])
+                       for row_idx, col_idx, value in updates
+                       if col_idx in names]
+
+        return _Merge(version, loaded, offsets, updates, moved, ours,
+                      dirty_cells, changed, len(conflicts))
+
+    def _apply_merge(self, merge):
+        """Bring the changes worked out by _prepare_merge() into the
+        model"""
+        if merge.loaded is None:
+            self.table.release()
+            self.table.saved(merge.offsets)
+            for row_idx, col_idx, value in merge.updates:
+                self.table.set(row_idx, col_idx, value)
+        else:
+            self._replace_table(merge.loaded)
+            self.history.remap(merge.moved)
+
+        for (row_idx, col_idx), value in sorted(merge.ours.items()):
+            new_idx = merge.moved.get(row_idx)
+            if new_idx is not None:
+                self.table.set(new_idx, col_idx, value)
+        self.dirty_cells = merge.dirty_cells
+        self.file_version = merge.version
+        self._rewrite_journal()
+
+        log.info("Merged changes to '%s' with %d edited cells (%d "
+                 "conflicts)", self.filename, len(merge.ours),
+                 merge.conflicts)
+
+        self._clear_summaries()
+        if merge.changed is None:
+            self._emit_structure_changed()
+        elif merge.changed:
+            self._emit_cells_changed(
+                sorted(set(row_idx for row_idx, key in merge.changed)),
+                sorted(set(key for row_idx, key in merge.changed)))
+        self._set_dirty(bool(self.dirty_cells))
+        self._emit_data_changed()
+
+    def _scan_changes(self):
+        # Compare the file with the table.  Returns its row offsets, a
+        # list of (row index, column index, value) for the cells without
+        # edits that differ, and a map of (row index, column index) to
+        # the file's value for each edited cell; or None if the rows no
+        # longer line up with the table's.
+        table = self.table
+        key_cols = self._key_cols()
+
+        offsets = array('l')
+        with open(self.filename, 'rb') as in_fp:
+            in_fp.seek(len(self.csv_format.bom))
+            col_titles = next(csvio.read_rows(in_fp, offsets,
+                                              self.csv_format), None)
+            if col_titles != self.col_titles:
+                raise IOError("The columns of '{}' have been changed by "
+                              "something else".format(self.filename))
+
+            # Blocks of rows are compared with the columns as they're
+            # parsed, and only the cells that differ are kept
+            if isinstance(table, ColumnStore):
+                in_fp.seek(offsets[-1])
+                differ = ColumnDiffer(table.columns, len(table), key_cols)
+                changes = self.csv_format.parse(in_fp, offsets,
+                                                differ).result()
+                if changes is None:
+                    return None
+                return self._split_changes(offsets, changes)
+
+            # The mapped backend re-reads everything from the file
+            # anyway, so only the key columns and the edited ones are
+            # needed
+            col_indices = sorted(set(key_cols).union(
+                self.dirty_cells.col_indices()))
+            workers = parallel.worker_count(self.filename, self.workers)
+            column_list, nrows = parallel.read_columns(
+                in_fp, offsets, workers, col_indices, self.csv_format)
+        if nrows != len(table):
+            return None
+        columns = dict(zip(col_indices, column_list))
+
+        for col_idx in key_cols:
+            if table.column(col_idx).changed_rows(columns[col_idx]):
+                return None
+
+        theirs = {}
+        for row_idx, col_idx, base in self.dirty_cells.cells():
+            theirs[(row_idx, col_idx)] = columns[col_idx].get(row_idx)
+        return offsets, [], theirs
+
+    def _split_changes(self, offsets, changes):
+        # Split the cells found by _scan_changes() to differ into those
+        # without edits and those with
+        updates = []
+        theirs = {}
+        for row_idx, col_idx, base in self.dirty_cells.cells():
+            theirs[(row_idx, col_idx)] = self.table.get(row_idx, col_idx)
+        for row_idx, col_idx, value in changes:
+            if (row_idx, col_idx) in theirs:
+                theirs[(row_idx, col_idx)] = value
+            else:
+                updates.append((row_idx, col_idx, value))
+        return offsets, updates, theirs
+
+    def _match_rows(self, loaded):
+        # Match the rows that have been edited, or that can be undone or
+        # redone, up with the rows of a reloaded file, by their paths
+        # and their positions among rows with the same path.  Returns a
+        # map of old to new row index, leaving out rows that have been
+        # removed, and a map of (old row index, column index) to the
+        # file's value for each edited cell, or None if it was removed.
+        if loaded.col_titles != self.col_titles:
+            raise IOError("The columns of '{}' have been changed by "
+                          "something else".format(self.filename))
+
+        paths = set(tuple(self.path_at_row(row_idx)) for row_idx
+                    in self.history.rows().union(self.dirty_cells))
+        moved = {}
+        for path in paths:
+            moved.update(zip(self.index.row_indices(list(path)),
+                             loaded.index.row_indices(list(path))))
+
+        theirs = {}
+        for row_idx, col_idx, base in self.dirty_cells.cells():
+            if row_idx in moved:
+                theirs[(row_idx, col_idx)] = loaded.table.get(
+                    moved[row_idx], col_idx)
+            else:
+                theirs[(row_idx, col_idx)] = None
+        return moved, theirs
+
+    def metadata_keys(self):
+        self._lazy_load()
+        return [info.name for info in self.schema.metadata]
+
+    def metadata_values(self, path):
+        """Get the distinct values at the level below a path prefix, in
+        the order of the column's declared type, or else natural_key()
+        order.
+
+        The list is cached, so it must not be modified."""
+        self._lazy_load()
+
+        # Full paths have no level below them
+        if len(path) >= len(self.schema.metadata):
+            return []
+
+        prefix = tuple(path)
+        values = self.values_cache.get(prefix)
+        if values is None:
+            values = self.index.children(path)
+            ctype = self.schema.metadata[len(path)].type
+            if ctype is not None:
+                values.sort(key=ctype.sort_key)
+            else:
+                values.sort(key=natural_key)
+            self.values_cache[prefix] = values
+        return values
+
+    def measurement_keys(self):
+        self._lazy_load()
+        return [info.name for info in self.schema.measurements]
+
+    def is_measurement_mutable(self, key):
+        self._lazy_load()
+        info = self.schema.measurement(key)
+        return info is not None and info.mutable
+
+    def measurement_type(self, key):
+        """Get the declared ColumnType of a measurement, or None"""
+        self._lazy_load()
+        return self._measurement(key).type
+
+    def row_count(self):
+        self._lazy_load()
+        return len(self.table)
+
+    def row_with_path(self, path):
+        """Get the index of the table row with the specified full path,
+        or None if there isn't one"""
+        self._lazy_load()
+        return self.index.row_index(path)
+
+    def _measurement(self, key):
+        info = self.schema.measurement(key)
+        assert info is not None
+        return info
+
+    def validate_path(self, path, partial=False):
+        self._lazy_load()
+
+        if partial:
+            return self.index.find(path) is not None
+        else:
+            return self.index.row_index(path) is not None
+
+    def paths_with_prefix(self, prefix=[]):
+        self._lazy_load()
+        return self.index.paths(prefix)
+
+    def rows_with_prefix(self, prefix=[]):
+        """Get the indices of the table rows with the specified path prefix"""
+        self._lazy_load()
+        return self.index.row_indices(prefix)
+
+    def has_rows_with_prefix(self, row_indices, prefix=[]):
+        """Whether any of the specified table rows have a path prefix,
+        without listing every row that has it"""
+        self._lazy_load()
+        found = self.index.find(prefix)
+        if found is None or not len(row_indices):
+            return False
+
+        # A prefix covering the whole table needs no checking
+        start, end = found
+        if end - start == len(self.table):
+            return True
+
+        key_cols = self.schema.key_cols[:len(prefix)]
+        for row_idx in row_indices:
+            if all(self.table.get(row_idx, col_idx) == element
+                   for col_idx, element in zip(key_cols, prefix)):
+                return True
+        return False
+
+    def measurement_summary(self, path):
+        """Get the distinct values of every measurement column over the
+        rows with the specified path prefix.
+
+        Returns a map of measurement key to sorted list of values."""
+        self._lazy_load()
+
+        summary = self._cached_summary(self.summary_cache, path)
+
+        # Fill in any columns that haven't been computed yet, or that
+        # have been invalidated by edits, in a single pass over the rows
+        missing = [info for info in self.schema.measurements
+                   if info.name not in summary]
+        if missing:
+            row_indices = self.index.row_indices(path)
+            distinct = self.table.distinct_values(
+                row_indices, [info.idx for info in missing])
+            for info, values in zip(missing, distinct):
+                # Typed values are sorted by value, e.g. '9' before '10'
+                if info.type is not None:
+                    summary[info.name] = sorted(values,
+                                                key=info.type.sort_key)
+                else:
+                    summary[info.name] = sorted(values)
+
+        return summary
+
+    def measurement_values(self, path, key):
+        """Get the sorted distinct values of a measurement column over the
+        rows with the specified path prefix"""
+        return self.measurement_summary(path).get(key, [])
+
+    def measurement_stats(self, path, key):
+        """Get Statistics of a measurement over the rows with the
+        specified path prefix.
+
+        Values are converted by the column's declared type, or else as
+        plain numbers, and blank or invalid cells count as missing.
+        Each distinct value is only converted once."""
+        self._lazy_load()
+
+        stats_by_key = self._cached_summary(self.stats_cache, path)
+        stats = stats_by_key.get(key)
+        if stats is None:
+            info = self._measurement(key)
+            ctype = info.type or NUMBER
+            row_indices = self.index.row_indices(path)
+
+            column = self._typed_column(info)
+            if column is not None:
+                number_counts = column.number_counts(row_indices)
+            else:
+                number_counts = [
+                    (ctype.parse(value), count) for value, count
+                    in self.table.value_counts(row_indices, info.idx).items()]
+
+            stats = summarize(number_counts, info.type)
+            stats_by_key[key] = stats
+        return stats
+
+    def _typed_column(self, info):
+        # Get the TypedColumn holding a measurement, if it's loaded as one
+        table = self.table
+        if isinstance(table, ColumnStore) and info.idx < len(table.columns):
+            column = table.column(info.idx)
+            if isinstance(column, TypedColumn):
+                return column
+        return None
+
+    def _clear_summaries(self):
+        self.summary_cache = OrderedDict()
+        self.stats_cache = OrderedDict()
+
+    def _cached_summary(self, cache, path):
+        # Get the map of measurement key to summary for a prefix in one
+        # of the summary caches, adding an empty one if necessary
+        prefix = tuple(path)
+        summary = cache.pop(prefix, None)
+        if summary is None:
+            summary = {}
+            while len(cache) >= SUMMARY_CACHE_SIZE:
+                cache.popitem(last=False)
+        cache[prefix] = summary
+        return summary
+
+    def _invalidate_summaries(self, path, key):
+        # The edited rows are all under `path`, so the only prefixes
+        # covering any of them are its ancestors and descendants
+        path = tuple(path)
+        for cache in (self.summary_cache, self.stats_cache):
+            for prefix, summary in cache.items():
+                depth = min(len(prefix), len(path))
+                if prefix[:depth] == path[:depth]:
+                    summary.pop(key, None)
+
+    def get_measurement(self, path, key):
+        self._lazy_load()
+        row_idx = self.row_with_path(path)
+        col_idx = self._measurement(key).idx
+
+        assert row_idx is not None
+        assert len(self.table) > row_idx
+
+        return self.table.get(row_idx, col_idx)
+
+    def get_row_values(self, row_idx):
+        """Get all the values in a table row, in the order of
+        metadata_keys() followed by measurement_keys()"""
+        self._lazy_load()
+        return [self.table.get(row_idx, info.idx)
+                for info in self.schema.metadata + self.schema.measurements]
+
+    def get_row_measurement(self, row_idx, key):
+        """Get a measurement in a single table row, even if other rows
+        share its path"""
+        self._lazy_load()
+        assert 0 <= row_idx < len(self.table)
+        return self.table.get(row_idx, self._measurement(key).idx)
+
+    def set_measurement(self, path, key, value, partial=False):
+        """Set a measurement in the row with a full path, which is the
+        last row if several share it; or if `partial` is set, in every
+        row with the path prefix"""
+        self._lazy_load()
+
+        info = self._measurement(key)
+        if info.type is not None:
+            info.type.validate(value)
+
+        if partial:
+            row_indices = self.index.row_indices(path)
+        else:
+            row_idx = self.index.row_index(path)
+            assert row_idx is not None
+            row_indices = [row_idx]
+        self._set_rows(path, row_indices, key, info.idx, value)
+
+    def set_row_measurement(self, row_idx, key, value):
+        """Set a measurement in a single table row, even if other rows
+        share its path"""
+        self._lazy_load()
+
+        info = self._measurement(key)
+        if info.type is not None:
+            info.type.validate(value)
+        assert 0 <= row_idx < len(self.table)
+
+        self._set_rows(self.path_at_row(row_idx), [row_idx], key, info.idx,
+                       value)
+
+    def _set_rows(self, path, row_indices, key, col_idx, value):
+        log.debug("%s - %s - %s (%d rows)", path, key, value, len(row_indices))
+
+        self.history.record(make_delta(self.table, path, key, col_idx,
+                                       row_indices, value))
+        self._change_rows(path, row_indices, key, col_idx, value)
+
+    def _change_rows(self, path, row_indices, key, col_idx, value):
+        self.change_count += 1
+
+        # Keep the value in the file of each newly edited cell, and
+        # forget about edited cells that are set back to it
+        dirty_rows = self.dirty_cells.column(col_idx)
+        for row_idx in row_indices:
+            if row_idx not in dirty_rows:
+                dirty_rows[row_idx] = self.table.get(row_idx, col_idx)
+            elif dirty_rows[row_idx] == value:
+                del dirty_rows[row_idx]
+        self.table.set_rows(row_indices, col_idx, value)
+
+        if self.journal is not None:
+            try:
+                self.journal.append(col_idx, value, row_indices)
+            except (IOError, OSError):
+                # Editing carries on without the journal
+                log.exception("Couldn't write to the journal of '%s'",
+                              self.filename)
+                self._drop_journal()
+
+        self._invalidate_summaries(path, key)
+        self._cells_changed(row_indices, key)
+
+    def can_undo(self):
+        return self.history.can_undo()
+
+    def can_redo(self):
+        return self.history.can_redo()
+
+    def undo(self):
+        """Undo the most recent edit, or batch of edits, that hasn't
+        been undone.  This takes time in proportion to the number of
+        cells changed."""
+        assert self.batch_depth == 0
+        if not self.history.can_undo():
+            return
+
+        step = self.history.undo()
+        with self.batch():
+            for delta in reversed(step):
+                for value, row_indices in delta.old_rows().items():
+                    self._change_rows(delta.path, row_indices, delta.key,
+                                      delta.col_idx, value)
+        log.debug("Undid %d edits", len(step))
+
+    def redo(self):
+        """Make the most recently undone edit, or batch of edits, again"""
+        assert self.batch_depth == 0
+        if not self.history.can_redo():
+            return
+
+        step = self.history.redo()
+        with self.batch():
+            for delta in step:
+                self._change_rows(delta.path, delta.rows, delta.key,
+                                  delta.col_idx, delta.new)
+        log.debug("Redid %d edits", len(step))
+
+    def set_measurements(self, edits, partial=False):
+        """Apply a sequence of (path, key, value) edits as one batch"""
+        with self.batch():
+            for path, key, value in edits:
+                self.set_measurement(path, key, value, partial)
+
+    def begin_batch(self):
+        """Start deferring change notifications until end_batch().  The
+        edits in between are undone as one step."""
+        if self.batch_depth == 0:
+            self.history.begin()
+        self.batch_depth += 1
+
+    def end_batch(self):
+        assert self.batch_depth > 0
+        self.batch_depth -= 1
+        if self.batch_depth == 0:
+            self.history.end()
+            self._flush_changes()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Context manager that groups edits into one change notification"""
+        self.begin_batch()
+        try:
+            yield self
+        finally:
+            self.end_batch()
+
+    def _cells_changed(self, row_indices, key):
+        self.pending_rows.update(row_indices)
+        self.pending_keys.add(key)
+        if self.batch_depth == 0:
+            self._flush_changes()
+
+    def _flush_changes(self):
+        if not self.pending_keys:
+            return
+
+        rows = sorted(self.pending_rows)
+        keys = sorted(self.pending_keys)
+        self.pending_rows = set()
+        self.pending_keys = set()
+
+        self._emit_cells_changed(rows, keys)
+        self._set_dirty(bool(self.dirty_cells))
+        self._emit_data_changed()
+
+    def commit(self, overwrite=False):
+        """Save the edits to the file.
+
+        If the file has been changed by something else, its changes are
+        merged in first; `overwrite` is as for _merge_changes()."""
+        self._lazy_load()
+
+        patch = self._merge_if_changed(overwrite)
+        committed = self._begin_commit()
+        try:
+            if patch and self._should_patch(committed):
+                written = self._write_changes(self._snapshot(committed))
+            else:
+                written = self._write_file()
+        except:
+            self._abort_commit(committed)
+            raise
+
+        self._finish_commit(written, committed)
+        self._write_caches(written)
+
+    def revert(self):
+        self._load()
+
+    def is_modified(self):
+        return self.dirty
+
+    def path_at_row(self, row_idx):
+        """Get the path corresponding to the specified row of the data table"""
+        self._lazy_load()
+        return [self.table.get(row_idx, col_idx)
+                for col_idx in self.schema.key_cols]
+
+    def path_next(self, path):
+        row_idx = self.row_with_path(path)
+
+        if row_idx is None:
+            return None
+
+        row_idx += 1 # Next row
+        if row_idx >= len(self.table):
+            return None
+
+        return self.path_at_row(row_idx)
+
+    def path_previous(self, path):
+        row_idx = self.row_with_path(path)
+
+        if row_idx is None:
+            return None
+
+        row_idx -= 1 # Previous row
+        if row_idx < 0:
+            return None
+
+        return self.path_at_row(row_idx)
+
+instrument.instrument(Measurements)
+
+# Local variables:
+# indent-tabs-mode: nil
+# tab-width: 4
+# End:
@@ -0,0 +1,215 @@
+import io
+import multiprocessing
+import os
+from array import array
+
+from zebo import csvio
+from zebo.columns import Column
+
+################################################################
+# Parallel CSV ingest
+################################################################
+
+# Files at least this large are parsed using multiple processes, unless
+# the number of workers is specified
+PARALLEL_SIZE_THRESHOLD = 32 << 20
+
+# Upper limit on the amount of data parsed by one task
+MAX_CHUNK_SIZE = 64 << 20
+
+def worker_count(filename, workers=None):
+    """Get the number of processes to use for reading a file"""
+    if workers is not None:
+        return max(1, workers)
+    if os.path.getsize(filename) < PARALLEL_SIZE_THRESHOLD:
+        return 1
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def _to_bytes(values):
+    # array.tostring() was renamed to tobytes() in Python 3
+    if hasattr(values, 'tobytes'):
+        return values.tobytes()
+    return values.tostring()
+
+def _from_bytes(typecode, data):
+    values = array(typecode)
+    if hasattr(values, 'frombytes'):
+        values.frombytes(data)
+    else:
+        values.fromstring(data)
+    return values
+
+class FileChanged(IOError):
+    """Raised by a worker if the file it opened by name isn't the one
+    being read, because the file has been replaced since"""
+
+def _identity(fp):
+    st = os.fstat(fp.fileno())
+    return (st.st_dev, st.st_ino)
+
+def _open(source):
+    # Workers can only open the file by name, so make sure that it's
+    # still the same file that the parent process has open
+    filename, identity = source
+    in_fp = open(filename, 'rb')
+    if _identity(in_fp) != identity:
+        in_fp.close()
+        raise FileChanged("'{}' was replaced while it was being read"
+                          .format(filename))
+    return in_fp
+
+def _count_quotes(task):
+    source, start, end = task
+    count = 0
+    with _open(source) as in_fp:
+        in_fp.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            data = in_fp.read(min(remaining, csvio.BLOCK_SIZE))
+            if not data:
+                break
+            count += data.count(b'"')
+            remaining -= len(data)
+    return count
+
+def _next_row_start(in_fp, pos, quoted, end):
+    """Find the first row boundary at or after `pos`.
+
+    `quoted` says whether `pos` lies inside a quoted field.  Escaped
+    quotes are doubled in CSV, so a newline that follows an even number
+    of quotes from a known unquoted position is a row boundary."""
+    in_fp.seek(pos)
+    while pos < end:
+        data = in_fp.read(min(end - pos, csvio.BLOCK_SIZE))
+        if not data:
+            break
+
+        search = 0
+        while True:
+            newline = data.find(b'\n', search)
+            if newline < 0:
+                quoted ^= data.count(b'"', search) % 2
+                break
+
+            quoted ^= data.count(b'"', search, newline) % 2
+            if not quoted:
+                return pos + newline + 1
+            search = newline + 1
+
+        pos += len(data)
+    return end
+
+def _split(in_fp, source, start, end, nchunks, pool):
+    """Split a byte range of a CSV file into chunks of whole rows"""
+    size = end - start
+    nominal = [start + (size * i) // nchunks for i in range(nchunks + 1)]
+
+    # Count the quotes in each nominal chunk, to find out whether each
+    # nominal boundary lies inside a quoted field
+    counts = pool.map(_count_quotes, [(source, nominal[i], nominal[i + 1])
+                                      for i in range(nchunks)])
+
+    bounds = [start]
+    quotes = 0
+    for i in range(1, nchunks):
+        quotes += counts[i - 1]
+        if nominal[i] <= bounds[-1]:
+            continue
+
+        boundary = _next_row_start(in_fp, nominal[i], quotes % 2, end)
+        if boundary > bounds[-1] and boundary < end:
+            bounds.append(boundary)
+    bounds.append(end)
+
+    return [(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)]
+
+def _parse_chunk(task):
+    source, start, end, col_indices, csv_format = task
+
+    with _open(source) as in_fp:
+        in_fp.seek(start)
+        data = in_fp.read(end - start)
+
+    offsets = array('l')
+    columns, nrows = csv_format.read_columns(io.BytesIO(data), offsets,
+                                             col_indices)
+
+    # Offsets are relative to the start of the chunk
+    offsets = array('l', [offset + start for offset in offsets])
+
+    # Arrays are sent back to the parent process as raw bytes, which is
+    # much cheaper to pickle than a list of ints
+    return ([(column.values, _to_bytes(column.codes)) for column in columns],
+            _to_bytes(offsets))
+
+def read_columns(in_fp, offsets, workers=1, col_indices=None,
+                 csv_format=csvio.DEFAULT_FORMAT):
+    """Parse the rows of a CSV file opened in binary mode using a pool
+    of processes.
+
+    Parsing starts at the last offset in `offsets`, which should be the
+    end of the header row.  The end offset of each row is appended to
+    `offsets`, exactly as for csvio.read_rows().  If `workers` is 1, the
+    file is parsed in this process.  `csv_format` is the CSVFormat of
+    the file.  The workers open the file by name, and raise FileChanged
+    if it's no longer the file that `in_fp` has open.
+
+    Returns a list of Columns, holding either every column of the file
+    or just those listed in `col_indices` with the rows in file order,
+    and the number of rows."""
+    start = offsets[-1]
+    end = os.fstat(in_fp.fileno()).st_size
+
+    if workers <= 1:
+        in_fp.seek(start)
+        return csv_format.read_columns(in_fp, offsets, col_indices)
+
+    nchunks = max(workers, (end - start) // MAX_CHUNK_SIZE + 1)
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        source = (in_fp.name, _identity(in_fp))
+        chunks = _split(in_fp, source, start, end, nchunks, pool)
+        tasks = [(source, chunk_start, chunk_end, col_indices, csv_format)
+                 for chunk_start, chunk_end in chunks]
+
+        if col_indices is None:
+            columns = []
+        else:
+            columns = [Column() for col_idx in col_indices]
+        nrows = 0
+
+        # Merge the chunks in file order as they become available,
+        # recoding each chunk's values into the merged dictionaries
+        for chunk_columns, chunk_offsets in pool.imap(_parse_chunk, tasks):
+            chunk_offsets = _from_bytes('l', chunk_offsets)
+            chunk_rows = len(chunk_offsets)
+
+            while len(columns) < len(chunk_columns):
+                columns.append(Column(nrows))
+
+            for col_idx, column in enumerate(columns):
+                if col_idx >= len(chunk_columns):
+                    column.append_missing_rows(chunk_rows)
+                    continue
+
+                values, codes = chunk_columns[col_idx]
+                column.extend(values, _from_bytes('i', codes))
+
+            offsets.extend(chunk_offsets)
+            nrows += chunk_rows
+
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return columns, nrows
+
+# Local variables:
+# indent-tabs-mode: nil
+# tab-width: 4
+# End:
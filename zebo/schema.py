@@ -0,0 +1,176 @@
+import datetime
+import re
+
+################################################################
+# Column descriptions
+################################################################
+
+NAN = float('nan')
+
+class ColumnType(object):
+    """Declared type of a column.
+
+    Cells are still held as the strings in the file, so they're written
+    back unchanged; a type converts them to floats for comparing and
+    aggregating.  Enum values convert to their position in the list of
+    choices, and dates to their proleptic Gregorian ordinal."""
+
+    __slots__ = ('name', 'convert', 'choices')
+
+    def __init__(self, name, convert, choices=None):
+        self.name = name
+        self.convert = convert
+        self.choices = choices
+
+    def parse(self, value):
+        """Convert a cell to a float, or NaN if it's blank or invalid"""
+        try:
+            return self.convert(value)
+        except (ValueError, OverflowError):
+            return NAN
+
+    def validate(self, value):
+        """Raise ValueError if a cell isn't blank or a valid value"""
+        if value.strip():
+            try:
+                self.convert(value)
+            except (ValueError, OverflowError):
+                raise ValueError("'{}' isn't a valid {}"
+                                 .format(value, self.name))
+
+    def format(self, number):
+        """Convert a float back to text, e.g. for showing statistics"""
+        if number != number:
+            return ''
+        if self.choices:
+            return self.choices[int(round(number))]
+        if self.name == 'date':
+            return datetime.date.fromordinal(int(round(number))).isoformat()
+        if abs(number) < 1e15 and number == int(number):
+            return str(int(number))
+        return '{:g}'.format(number)
+
+    def sort_key(self, value):
+        # Blank and invalid cells sort after the valid ones
+        number = self.parse(value)
+        if number != number:
+            return (1, 0.0, value)
+        return (0, number, value)
+
+def _to_int(value):
+    return float(int(value))
+
+def _to_date(value):
+    return float(datetime.datetime.strptime(value.strip(), '%Y-%m-%d')
+                 .toordinal())
+
+def _enum_type(choices):
+    positions = dict((choice, float(pos))
+                     for pos, choice in enumerate(choices))
+    def convert(value):
+        position = positions.get(value.strip())
+        if position is None:
+            raise ValueError(value)
+        return position
+    return ColumnType('enum', convert, choices)
+
+_TYPES = {'int': ColumnType('int', _to_int),
+          'float': ColumnType('float', float),
+          'date': ColumnType('date', _to_date)}
+
+# Type used for the statistics of columns without a declared type
+NUMBER = ColumnType('number', float)
+
+_ENUM_RE = re.compile(r'^enum\((.*)\)$')
+
+def parse_type(spec):
+    """Get the ColumnType for a type declaration such as 'int' or
+    'enum(low|high)', or None if it isn't one"""
+    spec = spec.strip()
+    match = _ENUM_RE.match(spec)
+    if match:
+        return _enum_type([choice.strip()
+                           for choice in match.group(1).split('|')])
+    return _TYPES.get(spec)
+
+class ColumnInfo(object):
+    """Description of one column of a CSV file"""
+
+    __slots__ = ('idx', 'name', 'title', 'metadata', 'mutable', 'type')
+
+    def __init__(self, idx, name, title, metadata=False, mutable=False,
+                 type=None):
+        self.idx = idx
+        self.name = name
+        self.title = title
+        self.metadata = metadata
+        self.mutable = mutable
+
+        # ColumnType, or None if the column holds plain strings
+        self.type = type
+
+class Schema(object):
+    """Classification of the columns of a CSV file by their titles.
+
+    Metadata column titles end with '=', and editable measurement
+    column titles with '?'; other columns are read-only measurements.
+    A type can be declared before the marker, e.g. 'Temp:float?' or
+    'Grade:enum(A|B|C)?'.  Measurements are looked up by name."""
+
+    def __init__(self, titles):
+        self.titles = titles
+        self.columns = []
+        self.metadata = []
+        self.measurements = []
+
+        for idx, title in enumerate(titles):
+            name = title.strip()
+            info = ColumnInfo(idx, name, title)
+
+            # Metadata column names end with '='
+            if name.endswith('='):
+                info.name = name[0:-1]
+                info.metadata = True
+                self.metadata.append(info)
+
+            # Measurement column names end with '?'
+            elif name.endswith('?'):
+                info.name = name[0:-1]
+                info.mutable = True
+                self.measurements.append(info)
+
+            else:
+                self.measurements.append(info)
+
+            if ':' in info.name:
+                name, spec = info.name.rsplit(':', 1)
+                info.type = parse_type(spec)
+                if info.type is not None:
+                    info.name = name
+
+            self.columns.append(info)
+
+        self.key_cols = [info.idx for info in self.metadata]
+
+        # If names are repeated, the first column with the name wins
+        self.by_name = dict((info.name, info)
+                            for info in reversed(self.measurements))
+        self.metadata_by_name = dict((info.name, info)
+                                     for info in reversed(self.metadata))
+
+    def measurement(self, name):
+        """Get the measurement column with the specified name, or None"""
+        return self.by_name.get(name)
+
+    def column(self, name):
+        """Get the measurement or else metadata column with the
+        specified name, or None"""
+        info = self.by_name.get(name)
+        if info is None:
+            info = self.metadata_by_name.get(name)
+        return info
+
+# Local variables:
+# indent-tabs-mode: nil
+# tab-width: 4
+# End:
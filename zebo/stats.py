@@ -0,0 +1,98 @@
+import math
+
+################################################################
+# Statistics of numeric measurements
+################################################################
+
+# Number of bins in the histogram of a column without an enum type
+HISTOGRAM_BINS = 10
+
+class Statistics(object):
+    """Statistics of the values of a measurement over a set of rows.
+
+    `count` is the number of rows with a valid value, and `missing` the
+    number with a blank or invalid one.  The other attributes are None if
+    `count` is zero.  `stddev` is the population standard deviation, and
+    `histogram` holds the number of values in each bin between
+    successive `edges`."""
+
+    __slots__ = ('count', 'missing', 'min', 'max', 'mean', 'stddev',
+                 'histogram', 'edges')
+
+    def __init__(self):
+        self.count = 0
+        self.missing = 0
+        self.min = None
+        self.max = None
+        self.mean = None
+        self.stddev = None
+        self.histogram = None
+        self.edges = None
+
+def _scale(*numbers):
+    # A power of two that the numbers can be divided by exactly to bring
+    # them below 2, so that sums and differences of them can't overflow
+    # even near the limits of a float
+    return math.ldexp(1.0, math.frexp(max(map(abs, numbers)))[1] - 1)
+
+def summarize(number_counts, ctype=None, bins=HISTOGRAM_BINS):
+    """Compute Statistics from (number, count) pairs, where NaN stands
+    for missing values.  Infinite numbers are counted as missing too.
+
+    Each distinct value only needs to appear once, so this takes time in
+    proportion to the number of distinct values rather than rows.  An
+    enum `ctype` gets one histogram bin per choice."""
+    stats = Statistics()
+
+    valid = []
+    for number, count in number_counts:
+        if number != number or math.isinf(number):
+            stats.missing += count
+        elif count:
+            valid.append((number, count))
+            stats.count += count
+    if not stats.count:
+        return stats
+
+    stats.min = min(number for number, count in valid)
+    stats.max = max(number for number, count in valid)
+
+    # Scaling by a power of two doesn't change the results, except to
+    # keep them from overflowing
+    scale = _scale(stats.min, stats.max)
+    mean = (math.fsum(number / scale * count for number, count in valid)
+            / stats.count)
+    stats.mean = mean * scale
+    stats.stddev = scale * math.sqrt(
+        math.fsum(count * (number / scale - mean) ** 2
+                  for number, count in valid) / stats.count)
+
+    if ctype is not None and ctype.choices:
+        low, high, bins = -0.5, len(ctype.choices) - 0.5, len(ctype.choices)
+    elif stats.max > stats.min:
+        low, high = stats.min, stats.max
+    else:
+        low, high, bins = stats.min, stats.max, 1
+
+    scale = _scale(low, high)
+    low_scaled = low / scale
+    width = (high / scale - low_scaled) / bins
+
+    stats.histogram = [0] * bins
+    for number, count in valid:
+        if width > 0:
+            # The top edge is included in the last bin
+            bin_idx = min(int((number / scale - low_scaled) / width),
+                          bins - 1)
+        else:
+            bin_idx = 0
+        stats.histogram[bin_idx] += count
+    stats.edges = ([(low_scaled + width * idx) * scale
+                    for idx in range(bins)] + [high])
+
+    return stats
+
+# Local variables:
+# indent-tabs-mode: nil
+# tab-width: 4
+# End: